@@ -22,19 +22,49 @@ A tool for upgrading a PostgreSQL cluster to a new major version using logical r
 Usage:
   pgrepup [-c config] config
   pgrepup [-c config] check [source|destination|all]
-  pgrepup [-c config] fix
-  pgrepup [-c config] setup
-  pgrepup [-c config] start
+  pgrepup [-c config] fix [-j N] [--mode=MODE] [--lock-timeout=MS] [--retries=N]
+  pgrepup [-c config] setup [-j N] [--split-dump] [--stream-schema] [--restart | --incremental]
+  pgrepup [-c config] start [-j N] [--sync-workers=N] [--max-sync-databases=N] [--max-source-active=N] [--max-lag=MB]
   pgrepup [-c config] status
-  pgrepup [-c config] stop
-  pgrepup [-c config] uninstall
+  pgrepup [-c config] progress [-j N] [--interval=S]
+  pgrepup [-c config] monitor [--interval=S] [--window=N]
+  pgrepup [-c config] exporter [--listen=ADDR] [--port=P] [--cache-ttl=S]
+  pgrepup [-c config] stop [-j N] [--timeout=S] [--wait-workers]
+  pgrepup [-c config] verify [-j N] [--chunk-rows=N | --sample=N]
+  pgrepup [-c config] switchover [-j N] [--timeout=S] [--terminate]
+  pgrepup [-c config] uninstall [-j N]
+  pgrepup [-c config] agent [--ttl=S | --kill]
   pgrepup -h | --help
   pgrepup --version
 
 Options:
-  -c config     Optional config file. [default: ~/.pgrepup]
-  -h --help     Show this screen
-  --version     Show version
+  -c config               Optional config file. [default: ~/.pgrepup]
+  -j N --jobs=N           Number of databases processed concurrently [default: 1]
+  --split-dump            Dump and restore the schema of each database separately
+  --stream-schema         Pipe the schema dump into the restore without temporary files
+  --sync-workers=N        Copy the data table by table, largest first, using N parallel sync workers
+  --max-sync-databases=N  Maximum number of databases copying data at the same time
+  --max-source-active=N   Pause new table copies while Source has more than N active sessions
+  --max-lag=MB            Pause new table copies while the replication lag exceeds MB megabytes
+  --interval=S            Seconds between two samples of replication lag or copy progress [default: 5]
+  --window=N              Number of samples used to compute apply rate and ETA [default: 12]
+  --listen=ADDR           Address the metrics exporter listens on [default: 127.0.0.1]
+  --port=P                Port the metrics exporter listens on [default: 9650]
+  --cache-ttl=S           Seconds the collected metrics are served from cache [default: 15]
+  --timeout=S             Seconds to wait for each pglogical operation on a database [default: 60]
+  --wait-workers          Wait also for the pglogical workers of each database to exit
+  --terminate             Terminate the client sessions opened on Source before the write freeze
+  --chunk-rows=N          Primary key values covered by each checksum compared by verify [default: 100000]
+  --sample=N              Compare only a random sample of about N rows of each table
+  --restart               Discard the progress of an interrupted setup and start from scratch
+  --incremental           Configure only the databases whose pglogical setup is missing or broken
+  --mode=MODE             How fix adds the unique field: auto, online or rewrite [default: auto]
+  --lock-timeout=MS       Milliseconds fix waits for the lock of a table before retrying it later [default: 5000]
+  --retries=N             Attempts of fix on a locked table before leaving it pending [default: 5]
+  --ttl=S                 Seconds the credential agent holds the master password key [default: 3600]
+  --kill                  Stop the running credential agent
+  -h --help               Show this screen
+  --version               Show version
 
 Quick start:
     1) Configure pgrepup using the config command
@@ -55,6 +85,8 @@ Quick start:
 from .version import __version__
 from .helpers.docopt_dispatch import dispatch
 from .commands import *
+from .helpers.database import close_connections
+from .helpers.state import close_state
 from clint.textui import puts, colored
 
 
@@ -65,3 +97,6 @@ def main():
     except KeyboardInterrupt:
         puts("\n" + colored.red('Execution aborted'))
         exit(0)
+    finally:
+        close_connections()
+        close_state()
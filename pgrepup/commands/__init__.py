@@ -6,3 +6,9 @@ from .start import start
 from .status import status
 from .uninstall import uninstall
 from .fix import fix
+from .monitor import monitor
+from .exporter import exporter
+from .progress import progress
+from .switchover import switchover
+from .verify import verify
+from .agent import agent
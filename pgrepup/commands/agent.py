@@ -0,0 +1,76 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+from clint.textui import colored, indent, puts
+from ..config import config
+from ..helpers.agent import AgentSocketError, get_agent_socket, kill_agent, open_agent_socket, serve_key
+from ..helpers.crypt import decrypt, get_key
+from ..helpers.docopt_dispatch import dispatch
+from ..helpers.ui import *
+
+
+@dispatch.on('agent')
+def agent(**kwargs):
+    if kwargs['kill']:
+        output_cli_message("Stop credential agent")
+        print(output_cli_result(kill_agent()))
+        return
+
+    if config().get('Security', 'encrypted_credentials') != 'y':
+        puts(colored.yellow("Credentials are not encrypted, the credential agent is not needed"))
+        return
+
+    try:
+        ttl = float(kwargs['ttl'])
+    except ValueError:
+        puts(colored.red("Invalid ttl"))
+        sys.exit(1)
+
+    # Ask the master password and check it against the stored credentials before handing out the key
+    decrypt(config().get('Source', 'password'))
+    key = get_key()
+    salt = config().get('Security', 'salt')
+
+    # A running agent is replaced, restarting the ttl
+    kill_agent()
+    try:
+        server = open_agent_socket()
+    except AgentSocketError as e:
+        puts(colored.red(str(e)))
+        sys.exit(1)
+    pid = os.fork()
+    if pid:
+        server.close()
+        output_cli_message("Credential agent listening on %s" % get_agent_socket(), color='cyan')
+        puts("")
+        with indent(4, quote=' >'):
+            output_cli_message("Process id")
+            print(output_cli_result(str(pid)))
+            output_cli_message("Key held for")
+            print(output_cli_result(format_duration(ttl)))
+        return
+
+    # Detach from the terminal as ssh-agent does
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    try:
+        serve_key(server, key, salt, ttl)
+    finally:
+        os._exit(0)
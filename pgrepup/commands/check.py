@@ -16,12 +16,16 @@
 # along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
 import re
 import subprocess
+import sys
+import threading
 import semver
 from clint.textui import indent
 from ..helpers.docopt_dispatch import dispatch
 from ..helpers.operation_target import get_target
 from ..helpers.database import *
+from ..helpers.hba import check_hba_access
 from ..helpers.ui import *
+from ..helpers.utils import parallel_map
 
 
 @dispatch.on('check')
@@ -40,6 +44,8 @@ def check(**kwargs):
         targets.append('Source')
         targets.append('Destination')
 
+    run_checks(targets)
+
     output_cli_message("Global checkings...", color='cyan')
     print
 
@@ -56,12 +62,9 @@ def check(**kwargs):
                                get_connection_params(t))
             c = checks(t, 'connection')
             print(output_cli_result(c['results']['connection']))
-            conn = None
-            if c['results']['connection']:
-                conn = c['data']['conn']
 
             output_cli_message("pglogical installation")
-            c = checks(t, 'pglogical_installed', db_conn=conn)
+            c = checks(t, 'pglogical_installed')
             if c['results']['pglogical_installed'] == 'NotInstalled':
                 print(output_cli_result(False))
                 print
@@ -74,7 +77,7 @@ def check(**kwargs):
                 print(output_cli_result(c['results']['pglogical_installed']))
 
             output_cli_message("pg_ddl_deploy installation")
-            c = checks(t, 'pg_ddl_deploy_installed', db_conn=conn)
+            c = checks(t, 'pg_ddl_deploy_installed')
             if c['results']['pg_ddl_deploy_installed'] == 'NotInstalled':
                 print(output_cli_result(False))
                 print
@@ -86,31 +89,31 @@ def check(**kwargs):
                 print(output_cli_result(c['results']['pg_ddl_deploy_installed']))
 
             output_cli_message("Needed wal_level setting")
-            c = checks(t, 'wal_level', db_conn=conn)
+            c = checks(t, 'wal_level')
             print(output_cli_result(c['results']['wal_level']))
             if not c['results']['wal_level']:
                 output_hint("Set wal_level to logical")
 
             output_cli_message("Needed max_worker_processes setting")
-            c = checks(t, 'max_worker_processes', db_conn=conn)
+            c = checks(t, 'max_worker_processes')
             print(output_cli_result(c['results']['max_worker_processes']))
             if not c['results']['max_worker_processes']:
                 output_hint("Increase max_worker_processes to %d" % c['data']['needed_worker_processes'])
 
             output_cli_message("Needed max_replication_slots setting")
-            c = checks(t, 'max_replication_slots', db_conn=conn)
+            c = checks(t, 'max_replication_slots')
             print(output_cli_result(c['results']['max_replication_slots']))
             if not c['results']['max_replication_slots']:
                 output_hint("Increase max_replication_slots to %d" % c['data']['needed_max_replication_slots'])
 
             output_cli_message("Needed max_wal_senders setting")
-            c = checks(t, 'max_wal_senders', db_conn=conn)
+            c = checks(t, 'max_wal_senders')
             print(output_cli_result(c['results']['max_wal_senders']))
             if not c['results']['max_wal_senders']:
                 output_hint("Increase max_wal_senders to %d" % c['data']['needed_max_wal_senders'])
 
             output_cli_message("pg_hba.conf settings")
-            c = checks(t, 'pg_hba.conf', db_conn=conn)
+            c = checks(t, 'pg_hba.conf')
             print(output_cli_result(c['results']['pg_hba.conf']))
             if not c['results']['pg_hba.conf']:
                 output_hint("Add the following lines to %s:" % c['data']['pg_hba.conf'])
@@ -119,14 +122,14 @@ def check(**kwargs):
                 print("    " + colored.yellow("After adding the lines, remember to reload postgreSQL"))
 
             output_cli_message("Local pg_dumpall version")
-            c = checks(t, 'pg_dumpall', db_conn=conn)
+            c = checks(t, 'pg_dumpall')
             print(output_cli_result(c['results']['pg_dumpall']))
             if not c['results']['pg_dumpall']:
                 output_hint(c['data']['pg_dumpall'])
 
             if t == 'Source':
                 output_cli_message("Source cluster tables without primary keys")
-                c = checks(t, 'src_databases', db_conn=conn)
+                c = checks(t, 'src_databases')
                 print
                 with indent(4, quote=' '):
                     for db in c['data']['src_databases'].keys():
@@ -139,232 +142,68 @@ def check(**kwargs):
                                 for table in c['data']['src_databases'][db].keys():
                                     output_cli_message(table)
                                     print(output_cli_result(c['data']['src_databases'][db][table], compensation=8))
-                                    if not c['data']['src_databases'][db][table]:
+                                    if c['data']['src_databases'][db][table]:
+                                        continue
+                                    unique_indexes = c['data']['src_unique_indexes'][db][table]
+                                    if unique_indexes:
+                                        output_hint("Use unique index %s as replica identity " % unique_indexes[0] +
+                                                    "(ALTER TABLE %s REPLICA IDENTITY USING INDEX %s)" % (
+                                                        table, unique_indexes[0]
+                                                    ))
+                                    else:
                                         output_hint("Add a primary key or unique index or use the pgrepup fix command")
 
 
-def checks(target, single_test=None, db_conn=None):
-    checks_to_do = [single_test] if single_test else [
-        "tmp_folder",
-        "connection",
-        "pglogical_installed",
-        "pg_ddl_deploy_installed",
-        "max_worker_processes",
-        "max_replication_slots",
-        "wal_level",
-        "max_wal_senders",
-        "pg_hba.conf",
-        "pg_dumpall",
-        "src_databases"
-    ]
+# Public checks, in the order they are evaluated and reported
+CHECKS = [
+    "tmp_folder",
+    "connection",
+    "pglogical_installed",
+    "pg_ddl_deploy_installed",
+    "max_worker_processes",
+    "max_replication_slots",
+    "wal_level",
+    "max_wal_senders",
+    "pg_hba.conf",
+    "pg_dumpall",
+    "src_databases"
+]
+
+# Dependency graph of the checks.
+# A dependency is either the name of a node of the same cluster or a (target, name) tuple referring to a node of
+# another cluster ('Source', 'Destination' or 'other'). A node is skipped when one of its dependencies of the same
+# cluster fails; dependencies of other clusters are passed as they are.
+DEPENDENCIES = {
+    "tmp_folder": [],
+    "connection": [],
+    "database_count": ["connection"],
+    "server_version": ["connection"],
+    "pglogical_installed": ["connection"],
+    "pg_ddl_deploy_installed": ["connection"],
+    "max_worker_processes": ["connection", "database_count"],
+    "max_replication_slots": ["connection", ("Source", "database_count")],
+    "wal_level": ["connection"],
+    "max_wal_senders": ["connection", "database_count"],
+    "pg_hba.conf": ["connection"],
+    "pg_dumpall": ["connection", "server_version", ("other", "server_version")],
+    "src_databases": ["connection"],
+}
+
+this = sys.modules[__name__]
+# Results of the nodes already evaluated, memoized for the life of the command
+this.results = {}
+this.results_lock = threading.Lock()
+
+
+def checks(target, single_test=None):
+    checks_to_do = [single_test] if single_test else CHECKS
+    run_checks([target], checks_to_do)
+
     checks_result = {}
     reusable_results = {}
     for c in checks_to_do:
-        checks_result[c] = 'Skipped'
-
-        if c == 'connection':
-            conn = connect(target)
-            checks_result[c] = True if conn else False
-            if conn:
-                reusable_results['conn'] = conn
-                db_conn = conn
-
-        elif c == 'pglogical_installed':
-            if not db_conn:
-                continue
-
-            # Look at installation instrutions at:
-            # https://2ndquadrant.com/it/resources/pglogical/pglogical-installation-instructions/
-            if check_extension(db_conn, 'pglogical'):
-                checks_result[c] = True
-
-            # The extension is not already present in db
-            # Check if we can install it using create extension command
-            checks_result[c] = create_extension(db_conn, 'pglogical', test=True)
-
-        elif c == 'pg_ddl_deploy_installed':
-            if not db_conn:
-                continue
-
-            # Look at installation instrutions at:
-            # https://github.com/enova/pgl_ddl_deploy
-            if check_extension(db_conn, 'pgl_ddl_deploy'):
-                checks_result[c] = True
-
-            # The extension is not already present in db
-            # Check if we can install it using create extension command
-            checks_result[c] = create_extension(db_conn, 'pglogical', test=False)
-            checks_result[c] = create_extension(db_conn, 'pgl_ddl_deploy', test=True)
-
-        elif c == 'max_worker_processes':
-            if not db_conn:
-                continue
-
-            if target == 'Source':
-                needed_worker_processes = int(get_database_count(db_conn)) + 1
-            else:
-                needed_worker_processes = int(get_database_count(db_conn))*2 + 1
-
-            current_worker_processes = get_setting_value(db_conn, 'max_worker_processes')
-            checks_result[c] = int(current_worker_processes) >= needed_worker_processes
-            if not checks_result[c]:
-                reusable_results['needed_worker_processes'] = needed_worker_processes
-
-        elif c == 'max_replication_slots':
-            if not db_conn:
-                continue
-            # See https://groups.google.com/a/2ndquadrant.com/forum/#!topic/bdr-list/hP0iDPQwAIU
-            if target == 'Destination':
-                source_db_conn = connect('Source')
-            else:
-                source_db_conn = db_conn
-            needed_value = get_database_count(source_db_conn)
-            current_value = get_setting_value(db_conn, 'max_replication_slots')
-            checks_result[c] = int(current_value) >= needed_value
-            if not checks_result[c]:
-                reusable_results['needed_max_replication_slots'] = needed_value
-
-        elif c == 'wal_level':
-            if not db_conn:
-                continue
-            needed_value = "logical"
-            current_value = get_setting_value(db_conn, 'wal_level')
-            checks_result[c] = current_value == needed_value
-
-        elif c == 'max_wal_senders':
-            if not db_conn:
-                continue
-
-            needed_value = int(get_database_count(db_conn)) if target == 'Source' else 0
-            current_value = get_setting_value(db_conn, 'max_wal_senders')
-            checks_result[c] = int(current_value) >= needed_value
-            if not checks_result[c]:
-                reusable_results['needed_max_wal_senders'] = needed_value
-
-        elif c == 'pg_hba.conf':
-            if not db_conn:
-                continue
-
-            rows = get_pg_hba_contents(db_conn)
-            if not rows:
-                continue
-
-            replication_rule = re.compile("^[ ]*host[ ]+replication[ ]+%s[ ]+%s/32[ ]+md5" % (
-                                            get_pgrepup_replication_user(),
-                                            get_connection_params('Destination')["host"]
-                                         ))
-            connection_rule = re.compile("^[ ]*host[ ]+all[ ]+%s[ ]+%s/32[ ]+md5" % (
-                                            get_pgrepup_replication_user(),
-                                            get_connection_params('Destination')["host"]
-                                         ))
-            replication_rule_present = False
-            connection_rule_present = False
-            for r in rows:
-                if replication_rule.match(r[0]):
-                    replication_rule_present = True
-
-                if connection_rule.match(r[0]):
-                    connection_rule_present = True
-
-            if replication_rule_present and connection_rule_present:
-                checks_result[c] = True
-            else:
-                checks_result[c] = False
-                reusable_results['pg_hba.conf'] = get_setting_value(db_conn, "hba_file")
-                reusable_results['pg_hba_replication_rule'] = "host replication %s %s/32 md5" % (
-                    get_pgrepup_replication_user(),
-                    get_connection_params('Destination')["host"]
-                )
-                reusable_results['pg_hba_connection_rule'] = "host all %s %s/32 md5" % (
-                    get_pgrepup_replication_user(),
-                    get_connection_params('Destination')["host"]
-                )
-        elif c == 'pg_dumpall':
-            if not db_conn:
-                continue
-
-            db_version = get_postgresql_version(db_conn)
-
-            if target == 'Source':
-                other_target_conn = connect('Destination')
-            else:
-                other_target_conn = connect('Source')
-            other_db_version = get_postgresql_version(other_target_conn)
-
-            if other_db_version > db_version:
-                db_version = other_db_version
-
-            db_version_rule = re.compile(r'^([0-9.]+)')
-            if not db_version_rule.match(db_version):
-                reusable_results['pg_dumpall'] = "Invalid PostgreSQL version %s" % db_version
-                checks_result[c] = False
-                continue
-            db_version = db_version_rule.match(db_version).group(1)
-
-            if db_version.count('.') < 2:
-                db_version += '.0'
-
-            pg_dumpall_exists = os.system("which pg_dumpall >/dev/null") == 0
-
-            if not pg_dumpall_exists:
-                reusable_results['pg_dumpall'] = "Install postgresql client utils locally."
-                checks_result[c] = False
-                continue
-            # see semver._REGEX
-            pgdumpall_version_rule = re.compile(r""".*pg_dumpall \(PostgreSQL\) ([0-9.]+).*""")
-            pg_dumpall_version = subprocess.check_output(["pg_dumpall", "--version"])
-            pg_dumpall_version = pgdumpall_version_rule.match(pg_dumpall_version)
-            if not pg_dumpall_version:
-                reusable_results['pg_dumpall'] = "Install PostgreSQL client utils locally."
-                checks_result[c] = False
-                continue
-            pg_dumpall_version = pg_dumpall_version.group(1)
-            if pg_dumpall_version.count('.') < 2:
-                pg_dumpall_version += '.0'
-            if semver.match(pg_dumpall_version, "<" + db_version):
-                checks_result[c] = False
-                reusable_results['pg_dumpall'] = "Upgrade local PostgreSQL client utils %s to version %s" % (
-                    pg_dumpall_version, db_version
-                )
-                continue
-
-            checks_result[c] = True
-
-        elif c == 'tmp_folder':
-            tmp_folder = os.path.expanduser(config().get('Security', 'tmp_folder'))
-            if not os.path.isdir(tmp_folder):
-                try:
-                    os.makedirs(tmp_folder, 0o700)
-                except os.error:
-                    checks_result[c] = False
-                    continue
-
-            try:
-                fname = "%s/%s" % (tmp_folder, uuid.uuid4().hex)
-                f = open(fname, "w")
-                f.write("test")
-                f.close()
-                os.unlink(fname)
-                checks_result[c] = True
-            except:
-                checks_result[c] = False
-
-        elif c == 'src_databases':
-            if not db_conn:
-                continue
-            if target == 'Destination':
-                checks_result[c] = True
-                continue
-
-            checks_result[c] = True
-            reusable_results['src_databases'] = {}
-            for db in get_cluster_databases(db_conn):
-                s_db_conn = connect('Source', db_name=db)
-                reusable_results['src_databases'][db] = {}
-                for table in get_database_tables(s_db_conn):
-                    t_r = table_has_primary_key(s_db_conn, table['schema'], table['table'])
-                    reusable_results['src_databases'][db]["%s.%s" % (table['schema'], table['table'])] = t_r
-                    checks_result[c] = checks_result[c] and t_r
+        checks_result[c], data = _evaluate(target, c)
+        reusable_results.update(data)
 
     overall_result = True
     for r in iter(checks_result.keys()):
@@ -375,3 +214,276 @@ def checks(target, single_test=None, db_conn=None):
         'results': checks_result,
         'data': reusable_results
     }
+
+
+def run_checks(targets, names=None):
+    """
+    Evaluate the checks of the given targets.
+
+    The nodes of the dependency graph are grouped by depth: the levels are run one after the other and, inside a
+    level, each cluster is checked concurrently. Each cluster connection is therefore used by a single thread and
+    the dependencies of a node are always already memoized when it is evaluated.
+    """
+    levels = {}
+    for t in targets:
+        for n in (names or CHECKS):
+            _collect_pending(t, n, levels)
+
+    by_level = {}
+    for (t, n), level in levels.items():
+        by_level.setdefault(level, {}).setdefault(t, []).append(n)
+
+    for level in sorted(by_level.keys()):
+        nodes = by_level[level]
+        for t in nodes.keys():
+            nodes[t].sort(key=_node_order)
+        list(parallel_map(
+            lambda target: [_evaluate(target, n) for n in nodes[target]],
+            sorted(nodes.keys()),
+            len(nodes)
+        ))
+
+
+def _node_order(name):
+    return CHECKS.index(name) if name in CHECKS else -1
+
+
+def _resolve_dependency(target, dependency):
+    if not isinstance(dependency, tuple):
+        return target, dependency
+    if dependency[0] == 'other':
+        return 'Destination' if target == 'Source' else 'Source', dependency[1]
+    return dependency
+
+
+def _collect_pending(target, name, levels):
+    """Fill levels with the nodes not yet evaluated needed by name, return the depth of the node"""
+    key = (target, name)
+    if key in this.results:
+        return -1
+    if key in levels:
+        return levels[key]
+
+    level = 0
+    for d in DEPENDENCIES[name]:
+        d_target, d_name = _resolve_dependency(target, d)
+        level = max(level, _collect_pending(d_target, d_name, levels) + 1)
+    levels[key] = level
+    return level
+
+
+def _evaluate(target, name):
+    """Return the memoized (result, data) tuple of a node, evaluating it and its dependencies if needed"""
+    key = (target, name)
+    if key in this.results:
+        return this.results[key]
+
+    deps = {}
+    skip = False
+    for d in DEPENDENCIES[name]:
+        deps[d] = _evaluate(*_resolve_dependency(target, d))[0]
+        if not isinstance(d, tuple):
+            skip = skip or deps[d] in (False, None, 'Skipped')
+
+    if skip:
+        result = ('Skipped', {})
+    else:
+        result = NODES[name](target, deps)
+
+    with this.results_lock:
+        this.results[key] = result
+    return result
+
+
+def _check_connection(target, deps):
+    conn = connect(target)
+    if not conn:
+        return False, {}
+    return True, {'conn': conn}
+
+
+def _check_database_count(target, deps):
+    return get_database_count(connect(target)), {}
+
+
+def _check_server_version(target, deps):
+    return get_postgresql_version(connect(target)), {}
+
+
+def _check_pglogical_installed(target, deps):
+    # Look at installation instrutions at:
+    # https://2ndquadrant.com/it/resources/pglogical/pglogical-installation-instructions/
+    db_conn = connect(target)
+    if check_extension(db_conn, 'pglogical'):
+        return True, {}
+
+    # The extension is not already present in db
+    # Check if we can install it using create extension command
+    return create_extension(db_conn, 'pglogical', test=True), {}
+
+
+def _check_pg_ddl_deploy_installed(target, deps):
+    # Look at installation instrutions at:
+    # https://github.com/enova/pgl_ddl_deploy
+    db_conn = connect(target)
+    if check_extension(db_conn, 'pgl_ddl_deploy'):
+        return True, {}
+
+    # The extension is not already present in db
+    # Check if we can install it using create extension command
+    create_extension(db_conn, 'pglogical', test=False)
+    return create_extension(db_conn, 'pgl_ddl_deploy', test=True), {}
+
+
+def _check_max_worker_processes(target, deps):
+    if target == 'Source':
+        needed_worker_processes = int(deps['database_count']) + 1
+    else:
+        needed_worker_processes = int(deps['database_count'])*2 + 1
+
+    current_worker_processes = get_setting_value(connect(target), 'max_worker_processes')
+    result = int(current_worker_processes) >= needed_worker_processes
+    return result, {} if result else {'needed_worker_processes': needed_worker_processes}
+
+
+def _check_max_replication_slots(target, deps):
+    # See https://groups.google.com/a/2ndquadrant.com/forum/#!topic/bdr-list/hP0iDPQwAIU
+    needed_value = deps[('Source', 'database_count')]
+    if needed_value in (None, 'Skipped'):
+        return 'Skipped', {}
+    current_value = get_setting_value(connect(target), 'max_replication_slots')
+    result = int(current_value) >= needed_value
+    return result, {} if result else {'needed_max_replication_slots': needed_value}
+
+
+def _check_wal_level(target, deps):
+    needed_value = "logical"
+    current_value = get_setting_value(connect(target), 'wal_level')
+    return current_value == needed_value, {}
+
+
+def _check_max_wal_senders(target, deps):
+    needed_value = int(deps['database_count']) if target == 'Source' else 0
+    current_value = get_setting_value(connect(target), 'max_wal_senders')
+    result = int(current_value) >= needed_value
+    return result, {} if result else {'needed_max_wal_senders': needed_value}
+
+
+def _check_pg_hba_conf(target, deps):
+    db_conn = connect(target)
+    access = check_hba_access(
+        db_conn,
+        get_connection_params('Destination')["host"],
+        get_pgrepup_replication_user(),
+        get_cluster_databases(db_conn) or []
+    )
+    if access is None:
+        return 'Skipped', {}
+
+    if access['replication'] and access['connection']:
+        return True, {}
+
+    return False, {
+        'pg_hba.conf': get_setting_value(db_conn, "hba_file"),
+        'pg_hba_replication_rule': "host replication %s %s/32 md5" % (
+            get_pgrepup_replication_user(),
+            get_connection_params('Destination')["host"]
+        ),
+        'pg_hba_connection_rule': "host all %s %s/32 md5" % (
+            get_pgrepup_replication_user(),
+            get_connection_params('Destination')["host"]
+        )
+    }
+
+
+def _check_pg_dumpall(target, deps):
+    db_version = deps['server_version']
+    other_db_version = deps[('other', 'server_version')]
+
+    if other_db_version not in (None, 'Skipped') and other_db_version > db_version:
+        db_version = other_db_version
+
+    db_version_rule = re.compile(r'^([0-9.]+)')
+    if not db_version_rule.match(db_version):
+        return False, {'pg_dumpall': "Invalid PostgreSQL version %s" % db_version}
+    db_version = db_version_rule.match(db_version).group(1)
+
+    if db_version.count('.') < 2:
+        db_version += '.0'
+
+    pg_dumpall_exists = os.system("which pg_dumpall >/dev/null") == 0
+
+    if not pg_dumpall_exists:
+        return False, {'pg_dumpall': "Install postgresql client utils locally."}
+    # see semver._REGEX
+    pgdumpall_version_rule = re.compile(r""".*pg_dumpall \(PostgreSQL\) ([0-9.]+).*""")
+    pg_dumpall_version = subprocess.check_output(["pg_dumpall", "--version"])
+    pg_dumpall_version = pgdumpall_version_rule.match(pg_dumpall_version)
+    if not pg_dumpall_version:
+        return False, {'pg_dumpall': "Install PostgreSQL client utils locally."}
+    pg_dumpall_version = pg_dumpall_version.group(1)
+    if pg_dumpall_version.count('.') < 2:
+        pg_dumpall_version += '.0'
+    if semver.match(pg_dumpall_version, "<" + db_version):
+        return False, {'pg_dumpall': "Upgrade local PostgreSQL client utils %s to version %s" % (
+            pg_dumpall_version, db_version
+        )}
+
+    return True, {}
+
+
+def _check_tmp_folder(target, deps):
+    tmp_folder = os.path.expanduser(config().get('Security', 'tmp_folder'))
+    if not os.path.isdir(tmp_folder):
+        try:
+            os.makedirs(tmp_folder, 0o700)
+        except os.error:
+            return False, {}
+
+    try:
+        fname = "%s/%s" % (tmp_folder, uuid.uuid4().hex)
+        f = open(fname, "w")
+        f.write("test")
+        f.close()
+        os.unlink(fname)
+        return True, {}
+    except:
+        return False, {}
+
+
+def _check_src_databases(target, deps):
+    if target == 'Destination':
+        return True, {}
+
+    result = True
+    src_databases = {}
+    src_unique_indexes = {}
+    for db in get_cluster_databases(connect(target)):
+        s_db_conn = connect('Source', db_name=db)
+        src_databases[db] = {}
+        src_unique_indexes[db] = {}
+        for table in get_tables_replica_identity(s_db_conn):
+            table_name = "%s.%s" % (table['schema'], table['table'])
+            t_r = table_has_replica_identity(table)
+            src_databases[db][table_name] = t_r
+            src_unique_indexes[db][table_name] = table['unique_indexes']
+            result = result and t_r
+
+    return result, {'src_databases': src_databases, 'src_unique_indexes': src_unique_indexes}
+
+
+NODES = {
+    "tmp_folder": _check_tmp_folder,
+    "connection": _check_connection,
+    "database_count": _check_database_count,
+    "server_version": _check_server_version,
+    "pglogical_installed": _check_pglogical_installed,
+    "pg_ddl_deploy_installed": _check_pg_ddl_deploy_installed,
+    "max_worker_processes": _check_max_worker_processes,
+    "max_replication_slots": _check_max_replication_slots,
+    "wal_level": _check_wal_level,
+    "max_wal_senders": _check_max_wal_senders,
+    "pg_hba.conf": _check_pg_hba_conf,
+    "pg_dumpall": _check_pg_dumpall,
+    "src_databases": _check_src_databases,
+}
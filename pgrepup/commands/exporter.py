@@ -0,0 +1,148 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import time
+try:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+from ..helpers.docopt_dispatch import dispatch
+from ..helpers.replication import *
+from ..helpers.ui import *
+
+
+this = sys.modules[__name__]
+this.metrics = None
+this.collected_at = None
+this.cache_ttl = 0
+
+
+@dispatch.on('exporter')
+def exporter(**kwargs):
+    try:
+        port = int(kwargs['port'])
+        this.cache_ttl = float(kwargs['cache_ttl'])
+    except ValueError:
+        puts(colored.red("Invalid port or cache ttl"))
+        sys.exit(1)
+
+    # Shortcut to ask master password before output Configuration message
+    decrypt(config().get('Source', 'password'))
+
+    server = HTTPServer((kwargs['listen'], port), MetricsHandler)
+    output_cli_message("Serving metrics on http://%s:%d/metrics" % (kwargs['listen'], port), color='cyan')
+    puts("")
+    server.serve_forever()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = get_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_metrics():
+    """Return the metrics in Prometheus text format, collecting them again only when the cache has expired"""
+    if this.metrics is None or time.time() - this.collected_at >= this.cache_ttl:
+        this.metrics = collect_metrics()
+        this.collected_at = time.time()
+    return this.metrics
+
+
+def collect_metrics():
+    """
+    Collect the replication state of all the databases.
+
+    Pooled connections are used, so a collection opens at most one connection per database plus one to the
+    Source cluster for the replication slots.
+    """
+    started = time.time()
+    lines = []
+    success = 1
+    try:
+        _collect_subscriptions(lines)
+        _collect_replication_lag(lines)
+    except psycopg2.Error:
+        success = 0
+    finally:
+        end_transactions()
+
+    _metric(lines, 'pgrepup_scrape_success', 'gauge', 'Whether the last collection succeeded', [({}, success)])
+    _metric(lines, 'pgrepup_scrape_duration_seconds', 'gauge', 'Duration of the last collection',
+            [({}, time.time() - started)])
+    return "\n".join(lines) + "\n"
+
+
+def _collect_subscriptions(lines):
+    status_samples = []
+    sync_samples = []
+    for db in get_cluster_databases(_connect('Destination')) or []:
+        r = get_replication_status(db)
+        status_samples.append(({'database': db, 'status': r['status'] or 'none'}, 1 if r['result'] else 0))
+
+        tables = get_tables_sync_status(db)
+        synchronized = len([t for t in tables if is_table_synchronized(t)])
+        sync_samples.append(({'database': db, 'state': 'synchronized'}, synchronized))
+        sync_samples.append(({'database': db, 'state': 'pending'}, len(tables) - synchronized))
+
+    _metric(lines, 'pgrepup_subscription_status', 'gauge',
+            'pglogical subscription status of each Destination database', status_samples)
+    _metric(lines, 'pgrepup_sync_tables', 'gauge',
+            'Number of tables by initial synchronization state', sync_samples)
+
+
+def _collect_replication_lag(lines):
+    samples = []
+    for slot in get_replication_slots_positions(_connect('Source')):
+        if slot['lag'] is not None:
+            samples.append(({'database': slot['database'], 'slot': slot['slot']}, slot['lag']))
+    _metric(lines, 'pgrepup_replication_lag_bytes', 'gauge',
+            'Bytes of WAL not yet confirmed by the subscriber', samples)
+
+
+def _connect(target):
+    conn = connect(target)
+    if not conn:
+        raise psycopg2.OperationalError("Unable to connect to %s cluster" % target)
+    return conn
+
+
+def _metric(lines, name, metric_type, description, samples):
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s %s" % (name, metric_type))
+    for labels, value in samples:
+        if labels:
+            lines.append("%s{%s} %s" % (name, ",".join(
+                '%s="%s"' % (k, _escape_label(v)) for k, v in sorted(labels.items())
+            ), value))
+        else:
+            lines.append("%s %s" % (name, value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
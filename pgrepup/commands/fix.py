@@ -14,39 +14,169 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import time
 from ..helpers.docopt_dispatch import dispatch
 from ..helpers.ui import *
 from ..helpers.database import *
+from ..helpers.state import *
+from ..helpers.utils import get_jobs, parallel_map
 from clint.textui import colored, indent
 
+FIX_MODES = ['auto', 'online', 'rewrite']
+# In auto mode, tables smaller than this are fixed rewriting them, which is faster but locks the table meanwhile
+ONLINE_MIN_SIZE = 64 * 1024 * 1024
+# Seconds to wait before retrying a table whose lock wasn't acquired, doubled at each attempt
+RETRY_DELAY = 1
+
 
 @dispatch.on('fix')
-def fix():
+def fix(**kwargs):
+    mode = kwargs.get('mode') or 'auto'
+    if mode not in FIX_MODES:
+        puts(colored.red("Invalid fix mode %s, use one of %s" % (mode, ", ".join(FIX_MODES))))
+        sys.exit(1)
+    jobs = get_jobs(kwargs)
+    try:
+        lock_timeout = int(kwargs.get('lock_timeout') or 0)
+        retries = int(kwargs.get('retries') or 0)
+    except ValueError:
+        puts(colored.red("Invalid lock timeout or retries"))
+        sys.exit(1)
 
     # Shortcut to ask master password before output Configuration message
     decrypt(config().get('Source', 'password'))
 
+    if begin_operation('fix', [('Source', 'fix')]):
+        output_cli_message("Resume previous fix skipping the databases already fixed")
+        print(output_cli_result(True, compensation=-4))
+
     output_cli_message("Find Source cluster's databases with tables without primary key/unique index...", color='cyan')
     print
 
+    started = time.time()
+    pending = []
     db_conn = connect('Source')
+    if mode != 'rewrite' and not is_online_not_null_supported(db_conn):
+        if mode == 'auto':
+            output_hint("before PostgreSQL 12 the online fix can't set NOT NULL without a scan under exclusive lock, "
+                        "tables are rewritten")
+        else:
+            output_hint("before PostgreSQL 12 the online fix sets NOT NULL scanning the table under exclusive lock")
     with indent(4, quote=' >'):
-        for db in get_cluster_databases(db_conn):
+        # Databases are fixed concurrently, the tables of each database one at a time
+        for db, r in parallel_map(
+                lambda d: _fix_database(d, mode, lock_timeout, retries), get_cluster_databases(db_conn), jobs
+        ):
             output_cli_message(db)
-            s_db_conn = connect('Source', db_name=db)
-            tables_without_unique = False
-            with indent(4, quote=' '):
-                for table in get_database_tables(s_db_conn):
-                    t_r = table_has_primary_key(s_db_conn, table['schema'], table['table'])
-                    if not t_r:
-                        tables_without_unique = True
-                        print
-                        output_cli_message("Found %s.%s without primary key" % (table['schema'], table['table']))
-                        result = add_table_unique_index(s_db_conn, table['schema'], table['table'])
-                        print(output_cli_result(
-                            colored.green('Added %s field' % get_unique_field_name()) if result else False,
-                            compensation=4
-                        ))
-
-            if not tables_without_unique:
+            done, tables = r
+            if done is None:
+                print(output_cli_result(format_timed_result(True, None)))
+                continue
+            if not tables:
                 print(output_cli_result(True))
+                continue
+            print
+            with indent(4, quote=' '):
+                for t in tables:
+                    output_cli_message("Found %s.%s without primary key (%s)" % (
+                        t['schema'], t['table'], format_size(t['size'])
+                    ))
+                    print(output_cli_result(_format_table_result(t), compensation=4))
+                    if t['error']:
+                        output_hint(t['error'])
+                    if t['locked']:
+                        pending.append("%s: %s.%s" % (db, t['schema'], t['table']))
+
+    end_operation('fix')
+
+    output_cli_message("Time spent", color='cyan')
+    print(output_cli_result(format_duration(time.time() - started), compensation=-4))
+    output_cli_message("Tables still pending because locked", color='cyan')
+    print(output_cli_result(len(pending) == 0 or str(len(pending)), compensation=-4))
+    for t in pending:
+        output_hint("run fix again when %s is less busy" % t)
+
+
+def _fix_database(db, mode='auto', lock_timeout=0, retries=0):
+    """
+    Fix the tables of the database without replica identity.
+
+    Return whether all the tables were fixed, None if the database was already fixed by a previous run, and the
+    list of the tables found along with the outcome of their fix.
+    """
+    if is_step_done('fix', 'fix', 'Source', db):
+        return None, []
+
+    tables = []
+
+    def fix_tables():
+        s_db_conn = connect('Source', db_name=db)
+        set_lock_timeout(s_db_conn, lock_timeout)
+        try:
+            sizes = get_tables_size(s_db_conn)
+            for table in get_tables_replica_identity(s_db_conn):
+                if not table_has_replica_identity(table):
+                    size = sizes.get("%s.%s" % (table['schema'], table['table']), 0)
+                    tables.append(_fix_table_with_retries(s_db_conn, table, size, mode, retries))
+        finally:
+            # The connection is pooled: later users get the default timeout, not the one of fix
+            reset_lock_timeout(s_db_conn)
+        return all(t['result'] for t in tables)
+
+    return run_step('fix', 'fix', fix_tables, 'Source', db)[0], tables
+
+
+def _fix_table_with_retries(db_conn, table, size, mode, retries):
+    """
+    Fix the table retrying with a growing delay while its lock can't be acquired within lock_timeout.
+
+    Any other database error fails the table without retrying it.
+    """
+    result = {'schema': table['schema'], 'table': table['table'], 'size': size, 'result': None, 'attempts': 0,
+              'locked': False, 'elapsed': 0, 'error': None}
+    started = time.time()
+    delay = RETRY_DELAY
+    while True:
+        result['attempts'] += 1
+        try:
+            result['result'] = _fix_table(db_conn, table, size, mode)
+            result['locked'] = False
+            break
+        except psycopg2.Error as e:
+            if e.pgcode != LOCK_NOT_AVAILABLE:
+                result['error'] = str(e).strip()
+                result['result'] = None
+                result['locked'] = False
+                break
+            result['locked'] = True
+            if result['attempts'] > retries:
+                break
+            time.sleep(delay)
+            delay *= 2
+    result['elapsed'] = time.time() - started
+    return result
+
+
+def _format_table_result(t):
+    if t['locked']:
+        return colored.yellow("Locked, %d attempts" % t['attempts'])
+    if not t['result']:
+        return False
+    return colored.green("%s %.1fs" % (t['result'], t['elapsed']))
+
+
+def _fix_table(db_conn, table, size, mode):
+    """Give the table a replica identity, return the description of what was done or None on failure"""
+    if table['unique_indexes']:
+        index = table['unique_indexes'][0]
+        if set_replica_identity_index(db_conn, table['schema'], table['table'], index):
+            return 'Replica identity %s' % index
+        return None
+    # Before PostgreSQL 12 the online fix still locks the table for a full scan, auto mode rewrites it instead
+    if mode == 'online' or (mode == 'auto' and size >= ONLINE_MIN_SIZE and is_online_not_null_supported(db_conn)):
+        if add_table_unique_field_online(db_conn, table['schema'], table['table']):
+            return 'Added %s field online' % get_unique_field_name()
+        return None
+    if add_table_unique_index(db_conn, table['schema'], table['table']):
+        return 'Added %s field' % get_unique_field_name()
+    return None
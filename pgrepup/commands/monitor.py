@@ -0,0 +1,99 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import time
+from collections import deque
+from ..helpers.docopt_dispatch import dispatch
+from ..helpers.replication import *
+from ..helpers.ui import *
+
+
+@dispatch.on('monitor')
+def monitor(**kwargs):
+    try:
+        interval = float(kwargs['interval'])
+        window = max(2, int(kwargs['window']))
+    except ValueError:
+        puts(colored.red("Invalid interval or window"))
+        sys.exit(1)
+
+    # Shortcut to ask master password before output Configuration message
+    decrypt(config().get('Source', 'password'))
+
+    samples = {}
+    while True:
+        started = time.time()
+        error = None
+        try:
+            conn = connect('Source')
+            if not conn:
+                raise psycopg2.OperationalError("Unable to connect to Source cluster")
+            # Don't keep a transaction open between two samples
+            conn.autocommit = True
+            for slot in get_replication_slots_positions(conn):
+                key = (slot['database'], slot['slot'])
+                if key not in samples:
+                    samples[key] = deque(maxlen=window)
+                samples[key].append((started, slot))
+        except psycopg2.Error as e:
+            error = str(e).strip()
+
+        _render(samples, interval, error)
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+def get_lag_statistics(samples):
+    """
+    Compute lag statistics from a window of (time, slot position) samples of a replication slot.
+
+    The apply rate is the speed at which the confirmed position of the slot moves forward, the WAL rate is the speed
+    at which the Source generates WAL. The ETA to catch up is available only if the apply rate is the highest.
+    """
+    last_time, last = samples[-1]
+    first_time, first = samples[0]
+    result = {'lag': last['lag'], 'apply_rate': None, 'wal_rate': None, 'eta': None}
+    elapsed = last_time - first_time
+    if elapsed <= 0 or first['confirmed_lsn'] is None or last['confirmed_lsn'] is None:
+        return result
+
+    result['apply_rate'] = (last['confirmed_lsn'] - first['confirmed_lsn']) / elapsed
+    result['wal_rate'] = (last['current_lsn'] - first['current_lsn']) / elapsed
+    if last['lag'] == 0:
+        result['eta'] = 0
+    elif result['apply_rate'] > result['wal_rate']:
+        result['eta'] = last['lag'] / (result['apply_rate'] - result['wal_rate'])
+    return result
+
+
+def _render(samples, interval, error):
+    # Clear the screen and move the cursor to the top left corner
+    sys.stdout.write("\033[2J\033[H")
+    puts(colored.cyan("Replication lag at %s (refresh every %ss, Ctrl-C to exit)" % (
+        time.strftime('%Y-%m-%d %H:%M:%S'), interval
+    )))
+    puts("")
+    if error:
+        puts(colored.red(error))
+        puts("")
+
+    puts("%-30s %-30s %12s %12s %12s" % ("Database", "Slot", "Behind", "Apply MB/s", "ETA"))
+    for key in sorted(samples.keys()):
+        stats = get_lag_statistics(samples[key])
+        behind = format_size(stats['lag']) if stats['lag'] is not None else '-'
+        apply_rate = "%.2f" % (stats['apply_rate'] / 1024.0 / 1024.0) if stats['apply_rate'] is not None else '-'
+        eta = format_duration(stats['eta']) if stats['eta'] is not None else '-'
+        line = "%-30s %-30s %12s %12s %12s" % (key[0], key[1], behind, apply_rate, eta)
+        puts(colored.green(line) if stats['lag'] == 0 else line)
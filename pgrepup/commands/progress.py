@@ -0,0 +1,124 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import time
+from clint.textui import indent
+from ..helpers.docopt_dispatch import dispatch
+from ..helpers.replication import *
+from ..helpers.ui import *
+from ..helpers.utils import get_jobs, parallel_map
+
+SYNC_STATUS_DESCRIPTIONS = {
+    'i': 'init',
+    's': 'structure',
+    'd': 'data copy',
+    'c': 'constraints',
+    'w': 'sync wait',
+    'u': 'catchup',
+    'y': 'synchronized',
+    'r': 'ready',
+}
+
+
+@dispatch.on('progress')
+def progress(**kwargs):
+    jobs = get_jobs(kwargs)
+    try:
+        interval = float(kwargs['interval'])
+    except ValueError:
+        puts(colored.red("Invalid interval"))
+        sys.exit(1)
+
+    # Shortcut to ask master password before output Configuration message
+    decrypt(config().get('Source', 'password'))
+
+    output_cli_message("Initial synchronization progress", color='cyan')
+    puts("")
+
+    # Destination sizes are sampled twice in order to estimate the copy rate
+    databases = get_cluster_databases(connect('Destination'))
+    first = dict(parallel_map(get_sync_progress, databases, jobs))
+    first_time = time.time()
+    time.sleep(interval)
+    second = dict(parallel_map(get_sync_progress, databases, jobs))
+    elapsed = time.time() - first_time
+
+    totals = {'source_size': 0, 'copied': 0, 'rate': 0}
+    with indent(4, quote=' >'):
+        for db in databases:
+            output_cli_message(db)
+            stats = get_progress_statistics(first[db], second[db], elapsed)
+            if not stats['tables']:
+                print(output_cli_result('Skipped, no subscription'))
+                continue
+            print(output_cli_result(_format_progress(stats)))
+            for k in totals.keys():
+                totals[k] += stats[k]
+
+            with indent(4, quote=' '):
+                for t in stats['tables']:
+                    if is_table_synchronized(t):
+                        continue
+                    output_cli_message("%s.%s (%s)" % (
+                        t['schema'], t['table'], SYNC_STATUS_DESCRIPTIONS.get(t['status'], t['status'])
+                    ))
+                    print(output_cli_result(_format_progress(t), compensation=4))
+
+        output_cli_message("Overall")
+        if totals['source_size']:
+            totals['percent'] = 100.0 * totals['copied'] / totals['source_size']
+            totals['eta'] = (totals['source_size'] - totals['copied']) / totals['rate'] if totals['rate'] > 0 else None
+            print(output_cli_result(_format_progress(totals)))
+        else:
+            print(output_cli_result('Skipped'))
+
+
+def get_progress_statistics(first, second, elapsed):
+    """
+    Compute the copy progress of a database from two samples returned by get_sync_progress().
+
+    The copied bytes of a table are estimated from its Destination size, capped to the Source size; tables already
+    synchronized are complete regardless of their size.
+    """
+    first_sizes = dict(((t['schema'], t['table']), t['destination_size']) for t in first)
+    result = {'tables': second, 'source_size': 0, 'copied': 0, 'rate': 0, 'percent': 100.0, 'eta': None}
+    for t in second:
+        if is_table_synchronized(t):
+            t['copied'] = t['source_size']
+            t['rate'] = 0
+        else:
+            t['copied'] = min(t['destination_size'], t['source_size'])
+            t['rate'] = max(0, t['destination_size'] - first_sizes.get((t['schema'], t['table']), 0)) / elapsed
+        t['percent'] = 100.0 * t['copied'] / t['source_size'] if t['source_size'] else 100.0
+        t['eta'] = (t['source_size'] - t['copied']) / t['rate'] if t['rate'] > 0 else None
+        result['source_size'] += t['source_size']
+        result['copied'] += t['copied']
+        result['rate'] += t['rate']
+
+    if result['source_size']:
+        result['percent'] = 100.0 * result['copied'] / result['source_size']
+    if result['rate'] > 0:
+        result['eta'] = (result['source_size'] - result['copied']) / result['rate']
+    return result
+
+
+def _format_progress(stats):
+    return "%.1f%% of %s, %s/s, ETA %s" % (
+        stats['percent'],
+        format_size(stats['source_size']),
+        format_size(stats['rate']),
+        format_duration(stats['eta']) if stats['eta'] is not None else '-'
+    )
@@ -17,14 +17,32 @@
 from clint.textui import indent
 from ..helpers.docopt_dispatch import dispatch
 from ..helpers.replication import *
-from ..helpers.utils import merge_two_dicts
-from ..config import get_tmp_folder
+from ..helpers.utils import get_jobs, parallel_map
+from ..helpers.schema import *
+from ..helpers.state import *
 from ..helpers.ui import *
-from .check import checks
+from .check import checks, run_checks
+
+# Steps of the setup in execution order, as (target, step)
+SETUP_STEPS = [
+    ('Destination', 'drop_node'),
+    ('Source', 'clean_pglogical'),
+    ('Destination', 'clean_pglogical'),
+    ('Source', 'create_user'),
+    ('Source', 'replication_sets'),
+    ('Source', 'pgl_ddl_deploy'),
+    ('Source', 'result'),
+    ('Destination', 'schema'),
+    ('Destination', 'pglogical_node'),
+    ('Destination', 'pgl_ddl_deploy'),
+    ('Destination', 'result'),
+]
 
 
 @dispatch.on('setup')
-def setup():
+def setup(**kwargs):
+    jobs = get_jobs(kwargs)
+    split_dump = kwargs['split_dump']
 
     result = True
     if check_destination_subscriptions():
@@ -36,8 +54,29 @@ def setup():
         print("    " + colored.yellow("Hint: use pgrepup stop to terminate the subscriptions"))
         sys.exit(1)
 
+    # A new setup makes the state of a previous uninstall or start meaningless
+    clear_operation('uninstall')
+    clear_operation('start')
+    if kwargs.get('restart'):
+        clear_operation('setup')
+    if begin_operation('setup', SETUP_STEPS):
+        output_cli_message("Resume previous setup from the first incomplete step")
+        print(output_cli_result(True, compensation=-4))
+
+    databases = None
+    if kwargs.get('incremental'):
+        databases = _get_databases_to_configure(jobs)
+        if not databases:
+            output_cli_message("All the databases are already configured")
+            print(output_cli_result(True, compensation=-4))
+            return
+        # Already configured databases must not be recreated by the restore of the whole cluster schema
+        split_dump = True
+        clear_databases('setup', databases)
+
     targets = ['Source', 'Destination']
     files_to_clean = []
+    set_up = []
     try:
         output_cli_message("Global tasks", color='cyan')
         puts("")
@@ -45,10 +84,13 @@ def setup():
             output_cli_message("Remove nodes from Destination cluster")
             print
             with indent(4, quote=' '):
-                for db in get_cluster_databases(connect('Destination')):
+                for db, r in parallel_map(
+                        lambda d: run_step('setup', 'drop_node', lambda: drop_node(d), 'Destination', d),
+                        _get_databases(connect('Destination'), databases),
+                        jobs
+                ):
                     output_cli_message(db)
-                    drop_node(db)
-                    print(output_cli_result(True, 4))
+                    print(output_cli_result(format_timed_result(*r), 4))
 
             output_cli_message("Create temp pgpass file")
             pg_pass = create_pgpass_file()
@@ -58,14 +100,18 @@ def setup():
                 output_cli_message("Drop pg_logical extension in all databases of %s cluster" % t)
                 print
                 with indent(4, quote=' '):
-                    for db in get_cluster_databases(connect(t)):
+                    for db, r in parallel_map(
+                            lambda d: run_step('setup', 'clean_pglogical', lambda: clean_pglogical_setup(t, d), t, d),
+                            _get_databases(connect(t), databases),
+                            jobs
+                    ):
                         output_cli_message(db)
-                        if not clean_pglogical_setup(t, db):
-                            print(output_cli_result(False, compensation=4))
-                            continue
-                        print(output_cli_result(True, compensation=4))
+                        print(output_cli_result(format_timed_result(*r), compensation=4))
 
         source_setup_results = {}
+        run_checks(targets)
+        # The schema can be streamed only if the Destination is going to be set up
+        stream_schema = kwargs['stream_schema'] and checks('Destination')['result']
         for t in targets:
             results = checks(t)
             output_cli_message("Setup %s" % t, color='cyan')
@@ -76,15 +122,25 @@ def setup():
             puts("")
             with indent(4, quote=' >'):
                 if t == 'Source':
-                    source_setup_results = _setup_source(results['data']['conn'], pg_pass)
+                    source_setup_results = _setup_source(
+                        results['data']['conn'], pg_pass, jobs, split_dump, stream_schema, databases
+                    )
                     if isinstance(source_setup_results, dict) and 'pg_dumpall' in source_setup_results:
                         files_to_clean.append(source_setup_results['pg_dumpall'])
+                    if isinstance(source_setup_results, dict) and 'pg_dump' in source_setup_results:
+                        files_to_clean.extend(f for f in source_setup_results['pg_dump'].values() if f)
                 else:
                     _setup_destination(
                         results['data']['conn'],
                         pg_pass=pg_pass,
-                        source_setup_results=source_setup_results
+                        source_setup_results=source_setup_results,
+                        jobs=jobs,
+                        databases=databases
                     )
+            set_up.append(t)
+
+        if set_up == targets:
+            end_operation('setup')
     finally:
         output_cli_message("Cleaning up", color='cyan')
         puts("")
@@ -103,83 +159,207 @@ def setup():
                     print(output_cli_result(False))
 
 
-def _setup_source(conn, pg_pass):
+def _get_databases(conn, databases=None):
+    """Return the databases of the cluster to set up: all of them, or only the given ones which exist"""
+    return [db for db in get_cluster_databases(conn) if databases is None or db in databases]
+
+
+def _get_databases_to_configure(jobs=1):
+    """Return the Source databases missing or broken in at least one of the clusters"""
+    output_cli_message("Find databases to configure", color='cyan')
+    puts("")
+    databases = []
+    with indent(4, quote=' >'):
+        for db, r in parallel_map(
+                lambda d: is_database_set_up('Source', d) and is_database_set_up('Destination', d),
+                get_cluster_databases(connect('Source')),
+                jobs
+        ):
+            output_cli_message(db)
+            print(output_cli_result(colored.green("Configured") if r else "To configure"))
+            if not r:
+                databases.append(db)
+    return databases
+
+
+def _setup_source(conn, pg_pass, jobs=1, split_dump=False, stream_schema=False, databases=None):
     result = {'result': True}
     output_cli_message("Create user for replication")
-    result['result'] = result['result'] and create_user(conn, get_pgrepup_replication_user(),
-                                                        get_pgrepup_user_password())
-    print(output_cli_result(result['result']))
-
-    pg_dumpall_schema = "%s/pg_dumpall_schema_%s.sql" % (get_tmp_folder(), uuid.uuid4().hex)
-    output_cli_message("Dump globals and schema of all databases")
-    pg_dumpall_schema_result = \
-        os.system('sh -c "PGPASSFILE=%(pgpass)s pg_dumpall -U %(user)s -h %(host)s -p%(port)s -s -f %(fname)s ' +
-                  '--if-exists -c"' %
-                  merge_two_dicts(
-                      get_connection_params('Source'),
-                      {"fname": pg_dumpall_schema, "pgpass": pg_pass}
-                  ))
-    result['result'] = result['result'] and pg_dumpall_schema_result == 0
-    print(output_cli_result(result['result']))
-
-    if pg_dumpall_schema_result == 0:
-        result['pg_dumpall'] = pg_dumpall_schema
+    r = run_step(
+        'setup', 'create_user',
+        lambda: create_user(conn, get_pgrepup_replication_user(), get_pgrepup_user_password()), 'Source'
+    )
+    result['result'] = result['result'] and r[0]
+    print(output_cli_result(format_timed_result(*r)))
+
+    schema_results = {}
+    if stream_schema:
+        schema_results = _stream_schema(conn, pg_pass, jobs, split_dump, result, databases)
+    elif split_dump:
+        # Databases whose schema was restored by a previous run don't need a dump
+        result['pg_dump'] = dict(
+            (db, None if is_step_done('setup', 'schema', 'Destination', db) else
+             get_dump_filename('pg_dump_schema', 'dump')) for db in _get_databases(conn, databases)
+        )
+        pg_dumpall_globals = get_dump_filename('pg_dumpall_globals', 'sql')
+        output_cli_message("Dump globals")
+        pg_dumpall_globals_result = dump_globals(pg_pass, pg_dumpall_globals)
+        result['result'] = result['result'] and pg_dumpall_globals_result
+        print(output_cli_result(result['result']))
+        if pg_dumpall_globals_result:
+            result['pg_dumpall'] = pg_dumpall_globals
+
+        output_cli_message("Dump schema of each database")
+        print
+        with indent(4, quote=' '):
+            for db, r in parallel_map(
+                    lambda d: dump_database_schema(pg_pass, d, result['pg_dump'][d]) if result['pg_dump'][d] else None,
+                    _get_databases(conn, databases),
+                    jobs
+            ):
+                output_cli_message(db)
+                if r is None:
+                    print(output_cli_result(format_timed_result(True, None), compensation=4))
+                    continue
+                schema_results[db] = r
+                print(output_cli_result(r, compensation=4))
+    elif is_step_done('setup', 'schema', 'Destination'):
+        output_cli_message("Dump globals and schema of all databases")
+        print(output_cli_result(format_timed_result(True, None)))
+    else:
+        pg_dumpall_schema = get_dump_filename('pg_dumpall_schema', 'sql')
+        output_cli_message("Dump globals and schema of all databases")
+        pg_dumpall_schema_result = dump_cluster_schema(pg_pass, pg_dumpall_schema)
+        result['result'] = result['result'] and pg_dumpall_schema_result
+        print(output_cli_result(result['result']))
+
+        if pg_dumpall_schema_result:
+            result['pg_dumpall'] = pg_dumpall_schema
 
     output_cli_message("Setup pglogical replication sets on Source node name")
     print
     with indent(4, quote=' '):
-        for db in get_cluster_databases(conn):
+        for db, r in parallel_map(
+                lambda d: run_step('setup', 'replication_sets', lambda: create_replication_sets(d), 'Source', d),
+                _get_databases(conn, databases),
+                jobs
+        ):
             output_cli_message(db)
-            if not create_replication_sets(db):
-                result[db] = False
-                print(output_cli_result(result[db], compensation=4))
-                continue
-            result[db] = True
-            print(output_cli_result(True, compensation=4))
+            result[db] = r[0] and schema_results.get(db, True)
+            print(output_cli_result(format_timed_result(*r), compensation=4))
     # see https://www.2ndquadrant.com/en/resources/pglogical/pglogical-docs/ 2.4.1
     # Automatic Assignment of Replication Sets for New Tables
     # and https://github.com/enova/pgl_ddl_deploy
     output_cli_message("Add triggers to replicate DDL statements on Source node")
     print
     with indent(4, quote=' '):
-        for db in get_cluster_databases(conn):
+        for db, r in parallel_map(
+                lambda d: run_step('setup', 'pgl_ddl_deploy', lambda: setup_pgl_ddl_deploy(d, target='Source'),
+                                   'Source', d),
+                _get_databases(conn, databases),
+                jobs
+        ):
             output_cli_message(db)
-            if not setup_pgl_ddl_deploy(db, target='Source'):
-                print(output_cli_result(False, compensation=4))
-                continue
-            print(output_cli_result(True, compensation=4))
+            print(output_cli_result(format_timed_result(*r), compensation=4))
 
-    for db in get_cluster_databases(conn):
-        store_setup_result('Source', db, result[db] and result['result'])
+    list(parallel_map(lambda d: _store_result('Source', d, result[d] and result['result']),
+                      _get_databases(conn, databases), jobs))
     return result
 
 
-def _setup_destination(conn, pg_pass, source_setup_results):
+def _store_result(target, db, result):
+    """Store the setup result of the database both in the database itself and in the state file"""
+    return run_step('setup', 'result', lambda: store_setup_result(target, db, result) and result, target, db)
+
+
+def _stream_schema(conn, pg_pass, jobs, split_dump, result, databases=None):
+    """Transfer the schema piping the dump of Source into the restore on Destination, without temporary files"""
+    schema_results = {}
+    # The restore drops and recreates the databases: pooled sessions would prevent it
+    close_connections('Destination')
+    if split_dump:
+        output_cli_message("Stream globals to Destination")
+        streamed = stream_globals(pg_pass)
+        print(output_cli_result(streamed))
+
+        output_cli_message("Stream schema of each database to Destination")
+        print
+        with indent(4, quote=' '):
+            for db, r in parallel_map(
+                    lambda d: run_step('setup', 'schema', lambda: stream_database_schema(pg_pass, d), 'Destination', d),
+                    _get_databases(conn, databases),
+                    jobs
+            ):
+                output_cli_message(db)
+                schema_results[db] = r[0]
+                print(output_cli_result(format_timed_result(*r), compensation=4))
+    else:
+        output_cli_message("Stream globals and schema of all databases to Destination")
+        streamed, elapsed = run_step('setup', 'schema', lambda: stream_cluster_schema(pg_pass), 'Destination')
+        print(output_cli_result(format_timed_result(streamed, elapsed)))
+
+    result['result'] = result['result'] and streamed
+    result['schema_streamed'] = streamed
+    result['schema_databases'] = schema_results
+    return schema_results
+
+
+def _setup_destination(conn, pg_pass, source_setup_results, jobs=1, databases=None):
     result = {'result': True}
-    output_cli_message("Create and import source globals and schema")
-    if 'pg_dumpall' in source_setup_results:
-        restore_schema_result = \
-            os.system(
-                'sh -c "PGPASSFILE=%(pgpass)s psql -U %(user)s -h %(host)s -p%(port)s -f %(fname)s -d postgres ' +
-                '>/dev/null 2>&1"'
-                % merge_two_dicts(
-                    get_connection_params('Destination'),
-                    {"fname": source_setup_results['pg_dumpall'], "pgpass": pg_pass}
-                ))
-
-        result['result'] = result['result'] and restore_schema_result == 0
-        print(output_cli_result(restore_schema_result == 0))
+    schema_results = {}
+    if 'schema_streamed' in source_setup_results:
+        output_cli_message("Create and import source globals and schema")
+        result['result'] = result['result'] and source_setup_results['schema_streamed']
+        schema_results = source_setup_results['schema_databases']
+        print(output_cli_result('Streamed' if source_setup_results['schema_streamed'] else False))
+    elif 'pg_dump' in source_setup_results:
+        output_cli_message("Create and import source globals")
+        if 'pg_dumpall' in source_setup_results:
+            restore_globals_result = restore_globals(pg_pass, source_setup_results['pg_dumpall'])
+            result['result'] = result['result'] and restore_globals_result
+            print(output_cli_result(restore_globals_result))
+        else:
+            result['result'] = result['result'] and False
+            print(output_cli_result('Skipped'))
+
+        # The restore drops and recreates the databases: pooled sessions would prevent it
+        close_connections('Destination')
+        output_cli_message("Create and import schema of each database")
+        print
+        with indent(4, quote=' '):
+            for db in sorted(source_setup_results['pg_dump'].keys()):
+                output_cli_message(db)
+                r = run_step('setup', 'schema', lambda: restore_database_schema(
+                    pg_pass, db, source_setup_results['pg_dump'][db], jobs
+                ), 'Destination', db)
+                schema_results[db] = r[0]
+                print(output_cli_result(format_timed_result(*r), compensation=4))
     else:
-        result['result'] = result['result'] and False
-        print(output_cli_result('Skipped'))
+        output_cli_message("Create and import source globals and schema")
+        if is_step_done('setup', 'schema', 'Destination') or 'pg_dumpall' in source_setup_results:
+            # The dump drops and recreates the databases: pooled sessions would prevent it
+            close_connections('Destination')
+            r = run_step('setup', 'schema', lambda: restore_cluster_schema(
+                pg_pass, source_setup_results['pg_dumpall']
+            ), 'Destination')
+            result['result'] = result['result'] and r[0]
+            print(output_cli_result(format_timed_result(*r)))
+        else:
+            result['result'] = result['result'] and False
+            print(output_cli_result('Skipped'))
 
+    conn = connect('Destination')
     output_cli_message("Setup pglogical Destination node name")
     print
     with indent(4, quote=' '):
-        for db in get_cluster_databases(conn):
+        for db, r in parallel_map(
+                lambda d: run_step('setup', 'pglogical_node', lambda: create_pglogical_node(d), 'Destination', d),
+                _get_databases(conn, databases),
+                jobs
+        ):
             output_cli_message(db)
-            result[db] = create_pglogical_node(db)
-            print(output_cli_result(result[db], compensation=4))
+            result[db] = r[0] and schema_results.get(db, True)
+            print(output_cli_result(format_timed_result(*r), compensation=4))
 
     # see https://www.2ndquadrant.com/en/resources/pglogical/pglogical-docs/ 2.4.1
     # Automatic Assignment of Replication Sets for New Tables
@@ -187,12 +367,14 @@ def _setup_destination(conn, pg_pass, source_setup_results):
     output_cli_message("Add triggers to replicate DDL statements on Destination node")
     print
     with indent(4, quote=' '):
-        for db in get_cluster_databases(conn):
+        for db, r in parallel_map(
+                lambda d: run_step('setup', 'pgl_ddl_deploy', lambda: setup_pgl_ddl_deploy(d, target='Destination'),
+                                   'Destination', d),
+                _get_databases(conn, databases),
+                jobs
+        ):
             output_cli_message(db)
-            if not setup_pgl_ddl_deploy(db, target='Destination'):
-                print(output_cli_result(False, compensation=4))
-                continue
-            print(output_cli_result(True, compensation=4))
+            print(output_cli_result(format_timed_result(*r), compensation=4))
 
-    for db in get_cluster_databases(conn):
-        store_setup_result('Destination', db, result[db] and result['result'])
+    list(parallel_map(lambda d: _store_result('Destination', d, result[d] and result['result']),
+                      _get_databases(conn, databases), jobs))
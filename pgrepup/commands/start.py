@@ -14,23 +14,133 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import time
 from clint.textui import indent
 from ..helpers.replication import *
 from ..helpers.docopt_dispatch import dispatch
+from ..helpers.scheduler import *
+from ..helpers.state import *
 from ..helpers.ui import *
 from ..helpers.database import *
+from ..helpers.utils import get_jobs, parallel_map
+
+# Steps of the start in execution order, as (target, step)
+START_STEPS = [
+    ('Destination', 'subscription'),
+    ('Destination', TABLE_SYNC_STEP),
+]
 
 
 @dispatch.on('start')
-def start():
+def start(**kwargs):
+    jobs = get_jobs(kwargs)
+    try:
+        sync_workers = int(kwargs['sync_workers'] or 0)
+        max_sync_databases = int(kwargs['max_sync_databases'] or 0)
+        max_source_active = int(kwargs['max_source_active']) if kwargs['max_source_active'] else None
+        max_lag = int(kwargs['max_lag']) * 1024 * 1024 if kwargs['max_lag'] else None
+    except ValueError:
+        puts(colored.red("Invalid synchronization options"))
+        sys.exit(1)
+
+    if not sync_workers and (max_sync_databases or max_source_active is not None or max_lag is not None):
+        puts(colored.red("Synchronization throttling requires the --sync-workers option"))
+        sys.exit(1)
 
     # Shortcut to ask master password before output Configuration message
     decrypt(config().get('Source', 'password'))
 
+    if begin_operation('start', START_STEPS):
+        output_cli_message("Resume previous start skipping the subscriptions already created")
+        print(output_cli_result(True, compensation=-4))
+
+    databases = get_cluster_databases(connect('Destination'))
+    pending = [d for d in databases if is_table_sync_pending(d)]
+    if pending and not sync_workers:
+        puts(colored.red("The data copy of %s was interrupted, resume it with the --sync-workers option" %
+                         ", ".join(pending)))
+        sys.exit(1)
+
     output_cli_message("Start replication and upgrade", color='cyan')
     puts("")
-    databases = get_cluster_databases(connect('Destination'))
     with indent(4, quote=' >'):
-        for d in databases:
+        # With scheduled synchronization the data is copied later, table by table
+        for d, r in parallel_map(lambda db: _start_database(db, sync_workers), databases, jobs):
             output_cli_message(d)
-            print(output_cli_result(start_subscription(d), 4))
+            print(output_cli_result(format_timed_result(*r), 4))
+
+    scheduled = [d for d in databases if is_table_sync_pending(d)]
+    if sync_workers and scheduled:
+        _schedule_table_sync(
+            scheduled,
+            sync_workers,
+            max_sync_databases,
+            get_source_load_throttle(max_source_active, max_lag)
+            if max_source_active is not None or max_lag is not None else None
+        )
+    end_operation('start')
+
+
+def _start_database(db, sync_workers):
+    """
+    Create the subscription of the database, unless created by a previous start.
+
+    A subscription created without data is recorded as pending until all its tables are synchronized, so that an
+    interrupted start resumes the copy of the remaining tables.
+    """
+    if not is_step_done('start', 'subscription', 'Destination', db):
+        # The tables synchronized for a previous subscription have to be copied again
+        clear_databases('start', [db])
+
+    def create():
+        if not start_subscription(db, synchronize_data=not sync_workers):
+            return False
+        if sync_workers:
+            now = time.time()
+            record_step('start', TABLE_SYNC_STEP, False, now, now, 'Destination', db)
+        return True
+
+    return run_step('start', 'subscription', create, 'Destination', db)
+
+
+def _schedule_table_sync(databases, sync_workers, max_sync_databases=0, throttle=None):
+    output_cli_message("Synchronize tables data", color='cyan')
+    puts("")
+    with indent(4, quote=' >'):
+        workers = get_sync_workers_limit(sync_workers)
+        output_cli_message("Parallel sync workers allowed by max_worker_processes")
+        print(output_cli_result(str(workers)))
+
+        tables = []
+        for db in databases:
+            db_tables = get_tables_to_sync(db)
+            if db_tables is None:
+                output_cli_message("%s: replication sets" % db)
+                print(output_cli_result(False))
+                continue
+            tables.extend(db_tables)
+        queues = plan_table_sync(tables, workers)
+        output_cli_message("Tables to synchronize")
+        print(output_cli_result(str(len(tables))))
+
+        failed = set()
+
+        def on_done(table, result):
+            output_cli_message("%s: %s.%s (%s)" % (
+                table['database'], table['schema'], table['table'], format_size(table['size'])
+            ))
+            print(output_cli_result(result))
+            record_table_sync(table, result)
+            if not result:
+                failed.add(table['database'])
+
+        def on_pause(reason):
+            output_cli_message("Synchronization of new tables")
+            print(output_cli_result("Paused, %s" % reason if reason else "Resumed"))
+
+        run_table_sync(queues, on_done, max_databases=max_sync_databases, throttle=throttle, on_pause=on_pause)
+
+        now = time.time()
+        for db in databases:
+            if db not in failed and get_tables_to_sync(db) == []:
+                record_step('start', TABLE_SYNC_STEP, True, now, now, 'Destination', db)
@@ -17,14 +17,16 @@
 from clint.textui import indent
 from ..helpers.docopt_dispatch import dispatch
 from ..helpers.ui import *
-from .check import checks
+from .check import checks, run_checks
 from ..helpers.replication import *
+from ..helpers.scheduler import get_tables_to_sync, is_table_sync_pending
+from ..helpers.state import get_steps_results
 from ..config import config
 from ..helpers.crypt import decrypt
 
 
 @dispatch.on('status')
-def status():
+def status(**kwargs):
     targets = ['Source', 'Destination']
 
     # Shortcut to ask master password before output Configuration message
@@ -33,6 +35,7 @@ def status():
     output_cli_message("Configuration", color='cyan')
     puts("")
     check_results = {}
+    run_checks(targets)
     with indent(4, quote=' >'):
         for t in targets:
             results = checks(t)
@@ -47,11 +50,13 @@ def status():
         for t in targets:
             output_cli_message("%s database cluster" % t)
             setup_results[t] = {}
+            # Results recorded by setup in the state file, the databases are queried only when missing
+            stored_results = get_steps_results('setup', 'result', t)
             print
             with indent(4, quote=' '):
                 for db in get_cluster_databases(connect(t)):
                     output_cli_message(db)
-                    setup_results[t][db] = get_setup_result(t, db)
+                    setup_results[t][db] = stored_results[db] if db in stored_results else get_setup_result(t, db)
                     print(output_cli_result(setup_results[t][db], compensation=4))
 
     output_cli_message("Replication status", color='cyan')
@@ -71,6 +76,12 @@ def status():
                     print
                     output_cli_message("Replication status")
                     print(output_cli_result(r['status'], compensation=4))
+                    # Subscriptions created by start --sync-workers get their data only from the scheduled copy
+                    if is_table_sync_pending(db):
+                        pending = get_tables_to_sync(db)
+                        output_cli_message("Tables never copied")
+                        print(output_cli_result(str(len(pending)) if pending is not None else False, compensation=4))
+                        output_hint("run pgrepup start --sync-workers=N again to resume the copy")
         output_cli_message("Xlog difference (bytes)")
 
         rep_delay = get_replication_delay()
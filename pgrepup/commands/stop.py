@@ -17,18 +17,39 @@
 from clint.textui import indent
 from ..helpers.replication import *
 from ..helpers.docopt_dispatch import dispatch
+from ..helpers.state import clear_operation
 from ..helpers.ui import *
+from ..helpers.utils import get_jobs, parallel_map, timed
 
 
 @dispatch.on('stop')
-def stop():
+def stop(**kwargs):
+    jobs = get_jobs(kwargs)
+    try:
+        timeout = float(kwargs.get('timeout') or DROP_TIMEOUT)
+    except ValueError:
+        puts(colored.red("Invalid timeout"))
+        sys.exit(1)
+    wait_workers = bool(kwargs.get('wait_workers'))
 
     # Shortcut to ask master password before output Configuration message
     decrypt(config().get('Source', 'password'))
 
     output_cli_message("Check active subscriptions in Destination nodes", color='cyan')
     puts("")
-    subscriptions = get_destination_subscriptions()
+    conn = connect('Destination')
+    if wait_workers and conn and int(get_setting_value(conn, 'server_version_num')) < 100000:
+        output_hint("pglogical workers can't be seen before PostgreSQL 10, only the subscription drop is waited for")
+    subscriptions = get_destination_subscriptions(jobs)
+    active = [s for s in subscriptions.keys() if subscriptions[s]]
+    # Sequences must be synchronized BEFORE stopping subscriptions
+    sequences_results = dict(parallel_map(lambda db: synchronize_and_verify_sequences(db, timeout), active, jobs))
+    stop_results = dict(parallel_map(
+        timed(lambda db: stop_subscription(db, timeout, wait_workers)), active, jobs
+    ))
+    if all(r[0] for r in stop_results.values()):
+        # The next start creates new subscriptions, with nothing to resume
+        clear_operation('start')
     with indent(4, quote=' >'):
         for s in iter(subscriptions.keys()):
             output_cli_message(s)
@@ -36,6 +57,20 @@ def stop():
             print(output_cli_result(message))
             if subscriptions[s]:
                 with indent(4, quote=' '):
+                    output_sequences_result(*sequences_results[s])
                     output_cli_message("Launch stop command")
-                    syncronize_sequences(s)  # must be done BEFORE stopping subscriptions
-                    print(output_cli_result(stop_subscription(s), 8))
+                    print(output_cli_result(format_timed_result(*stop_results[s]), 8))
+
+
+def output_sequences_result(count, lagging):
+    output_cli_message("Synchronize sequences")
+    if count is None or lagging is None:
+        print(output_cli_result(False, 8))
+    elif not lagging:
+        print(output_cli_result(colored.green("%d sequences" % count), 8))
+    else:
+        print(output_cli_result(colored.yellow("%d of %d sequences behind" % (len(lagging), count)), 8))
+        with indent(4, quote=' '):
+            for s in lagging:
+                output_cli_message(s['sequence'])
+                print(output_cli_result("%s < %s" % (s['destination'], s['source']), 12))
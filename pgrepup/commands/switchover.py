@@ -0,0 +1,156 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import time
+from clint.textui import indent
+from ..helpers.replication import *
+from ..helpers.docopt_dispatch import dispatch
+from ..helpers.state import clear_operation
+from ..helpers.ui import *
+from ..helpers.utils import get_jobs, parallel_map, timed, wait_until
+from .stop import output_sequences_result
+
+
+@dispatch.on('switchover')
+def switchover(**kwargs):
+    jobs = get_jobs(kwargs)
+    try:
+        timeout = float(kwargs.get('timeout') or DROP_TIMEOUT)
+    except ValueError:
+        puts(colored.red("Invalid timeout"))
+        sys.exit(1)
+
+    # Shortcut to ask master password before output Configuration message
+    decrypt(config().get('Source', 'password'))
+
+    output_cli_message("Check active subscriptions in Destination nodes", color='cyan')
+    subscriptions = get_destination_subscriptions(jobs)
+    databases = sorted(s for s in subscriptions.keys() if subscriptions[s])
+    print(output_cli_result(bool(databases), compensation=-4))
+    if not databases:
+        output_hint("use pgrepup start to replicate the Source databases before the switchover")
+        sys.exit(1)
+
+    # Pooled pgrepup sessions would be terminated along with the application ones
+    close_connections('Source')
+    conn = connect('Source')
+    # Until the subscriptions are stopped, any failure or interruption restores writes on Source
+    completed = False
+    try:
+        output_cli_message("Freeze writes on Source databases", color='cyan')
+        puts("")
+        with indent(4, quote=' >'):
+            frozen_at = time.time()
+            output_cli_message("Set default_transaction_read_only")
+            result = set_databases_read_only(conn, databases)
+            print(output_cli_result(result))
+            if not result:
+                sys.exit(1)
+
+            sessions = get_client_sessions(conn, databases)
+            if kwargs.get('terminate'):
+                output_cli_message("Terminate client sessions")
+                print(output_cli_result(str(terminate_sessions(conn, sessions))))
+            else:
+                output_cli_message("Client sessions opened before the freeze")
+                print(output_cli_result(len(sessions) == 0 or str(len(sessions))))
+                if sessions:
+                    # Their writes after the freeze LSN would be lost by the switchover
+                    output_hint("these sessions can still write, close them or use --terminate")
+                    sys.exit(1)
+            freeze_lsn = get_current_lsn(conn)
+
+        output_cli_message("Wait for Destination to apply the Source WAL", color='cyan')
+        puts("")
+        with indent(4, quote=' >'):
+            caught_up = _wait_replication(conn, databases, freeze_lsn, timeout)
+            for db in databases:
+                output_cli_message(db)
+                print(output_cli_result(format_timed_result(caught_up[db] is not None, caught_up[db] or timeout)))
+        if None in caught_up.values():
+            sys.exit(1)
+
+        output_cli_message("Stop replication", color='cyan')
+        puts("")
+        sequences_results = dict(parallel_map(
+            lambda db: synchronize_and_verify_sequences(db, timeout), databases, jobs
+        ))
+        # Sequences behind on Destination would hand out values already used on Source
+        synchronized = all(c is not None and lagging == [] for c, lagging in sequences_results.values())
+        stop_results = {}
+        if synchronized:
+            stop_results = dict(parallel_map(timed(lambda db: stop_subscription(db, timeout)), databases, jobs))
+        with indent(4, quote=' >'):
+            for db in databases:
+                output_cli_message(db)
+                print
+                with indent(4, quote=' '):
+                    output_sequences_result(*sequences_results[db])
+                    if db in stop_results:
+                        output_cli_message("Stop subscription")
+                        print(output_cli_result(format_timed_result(*stop_results[db]), 8))
+        if not synchronized:
+            sys.exit(1)
+        stopped = [db for db in databases if stop_results[db][0]]
+        if len(stopped) < len(databases):
+            if stopped:
+                output_hint("replication of %s was stopped, set it up again before the next switchover" %
+                            ", ".join(stopped))
+            sys.exit(1)
+        clear_operation('start')
+        completed = True
+    finally:
+        if not completed:
+            _unfreeze(databases)
+
+    output_cli_message("Write unavailability window", color='cyan')
+    print(output_cli_result(format_duration(time.time() - frozen_at), compensation=-4))
+    output_hint("Source databases are left read-only, point the application to the Destination cluster")
+
+
+def _wait_replication(conn, databases, lsn, timeout):
+    """
+    Wait until the pglogical slots of the databases confirm the given WAL position.
+
+    The slots of all the databases are polled with a single query. Return the seconds each database took to catch up,
+    None if it didn't within timeout.
+    """
+    started = time.time()
+    caught_up = {}
+
+    def applied():
+        for slot in get_replication_slots_positions(conn):
+            if slot['database'] in databases and slot['database'] not in caught_up and \
+                    slot['confirmed_lsn'] is not None and slot['confirmed_lsn'] >= lsn:
+                caught_up[slot['database']] = time.time() - started
+        return len(caught_up) == len(databases)
+
+    try:
+        wait_until(applied, timeout)
+    except psycopg2.Error as e:
+        print(e)
+    return dict((db, caught_up.get(db)) for db in databases)
+
+
+def _unfreeze(databases):
+    """Restore writes on the Source databases, printing the statements to run by hand if that fails"""
+    output_cli_message("Switchover aborted, restore writes on Source databases", color='cyan')
+    conn = connect('Source')
+    result = bool(conn) and set_databases_read_only(conn, databases, read_only=False)
+    print(output_cli_result(result, compensation=-4))
+    if not result:
+        for db in databases:
+            output_hint('run ALTER DATABASE "%s" RESET default_transaction_read_only on Source' % db.replace('"', '""'))
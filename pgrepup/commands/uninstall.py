@@ -17,13 +17,33 @@
 from clint.textui import indent
 from ..helpers.replication import *
 from ..helpers.docopt_dispatch import dispatch
+from ..helpers.state import *
 from ..helpers.ui import *
+from ..helpers.utils import get_jobs, parallel_map
 from .stop import stop
 
+# Steps of the uninstall in execution order, as (target, step)
+UNINSTALL_STEPS = [
+    ('Destination', 'drop_node'),
+    ('Source', 'clean_pgl_ddl_deploy'),
+    ('Destination', 'clean_pgl_ddl_deploy'),
+    ('Source', 'clean_pglogical'),
+    ('Destination', 'clean_pglogical'),
+    ('Source', 'drop_user'),
+    ('Source', 'drop_fields'),
+]
+
 
 @dispatch.on('uninstall')
-def uninstall():
-    stop()
+def uninstall(**kwargs):
+    jobs = get_jobs(kwargs)
+    stop(jobs=kwargs.get('jobs'))
+
+    # The setup is being removed: its state is meaningless
+    clear_operation('setup')
+    if begin_operation('uninstall', UNINSTALL_STEPS):
+        output_cli_message("Resume previous uninstall from the first incomplete step")
+        print(output_cli_result(True, compensation=-4))
 
     output_cli_message("Uninstall operations", color='cyan')
     puts("")
@@ -31,59 +51,77 @@ def uninstall():
         output_cli_message("Remove nodes from Destination cluster")
         print
         with indent(4, quote=' '):
-            for db in get_cluster_databases(connect('Destination')):
+            for db, r in parallel_map(
+                    lambda d: run_step('uninstall', 'drop_node', lambda: drop_node(d), 'Destination', d),
+                    get_cluster_databases(connect('Destination')),
+                    jobs
+            ):
                 output_cli_message(db)
-                drop_node(db)
-                print(output_cli_result(True, 4))
-        output_cli_message("Drop pgl_ddl_deploy extension in all databases")
-        print
-        with indent(4, quote=' '):
-            for t in ['Source', 'Destination']:
-                output_cli_message(t)
-                print
-                with indent(4, quote=' '):
-                    for db in get_cluster_databases(connect(t)):
-                        output_cli_message(db)
-                        if not clean_pgl_ddl_deploy(t, db):
-                            print(output_cli_result(False, compensation=8))
-                            continue
-                        print(output_cli_result(True, compensation=8))
+                print(output_cli_result(format_timed_result(*r), 4))
 
-        output_cli_message("Drop pg_logical extension in all databases")
-        print
-        with indent(4, quote=' '):
-            for t in ['Source', 'Destination']:
-                output_cli_message(t)
-                print
-                with indent(4, quote=' '):
-                    for db in get_cluster_databases(connect(t)):
-                        output_cli_message(db)
-                        if not clean_pglogical_setup(t, db):
-                            print(output_cli_result(False, compensation=8))
-                            continue
-                        print(output_cli_result(True, compensation=8))
+        for step, description, function in [
+            ('clean_pgl_ddl_deploy', "Drop pgl_ddl_deploy extension in all databases", clean_pgl_ddl_deploy),
+            ('clean_pglogical', "Drop pg_logical extension in all databases", clean_pglogical_setup),
+        ]:
+            output_cli_message(description)
+            print
+            with indent(4, quote=' '):
+                for t in ['Source', 'Destination']:
+                    output_cli_message(t)
+                    print
+                    with indent(4, quote=' '):
+                        for db, r in parallel_map(
+                                lambda d: run_step('uninstall', step, lambda: function(t, d), t, d),
+                                get_cluster_databases(connect(t)),
+                                jobs
+                        ):
+                            output_cli_message(db)
+                            print(output_cli_result(format_timed_result(*r), compensation=8))
 
         output_cli_message("Drop user for replication")
-        print(output_cli_result(drop_user(connect('Source'), get_pgrepup_replication_user())))
+        r = run_step('uninstall', 'drop_user', lambda: drop_user(connect('Source'), get_pgrepup_replication_user()),
+                     'Source')
+        print(output_cli_result(format_timed_result(*r)))
 
         output_cli_message("Drop unique fields added by fix command")
         print
         with indent(8, quote=' '):
-            src_db_conn = connect('Source')
-            for db in get_cluster_databases(src_db_conn):
+            for db, r in parallel_map(_drop_unique_fields, get_cluster_databases(connect('Source')), jobs):
                 output_cli_message(db)
+                done, tables = r
+                if done is None or not tables:
+                    print(output_cli_result(format_timed_result(True, None) if done is None else done, 8))
+                    continue
                 print
-                src_d_db_conn = connect('Source', db_name=db)
-                dest_d_db_conn = connect('Destination', db_name=db)
                 with indent(4, quote=' '):
-                    for table in get_database_tables(src_d_db_conn):
-                        output_cli_message("%s.%s" % (table['schema'], table['table']))
-                        s = drop_table_field(
-                            src_d_db_conn, table['schema'], table['table'], get_unique_field_name()
-                        )
-                        d = drop_table_field(
-                            dest_d_db_conn, table['schema'], table['table'], get_unique_field_name()
-                        )
-                        print(output_cli_result(s and d, compensation=12))
+                    for t in tables:
+                        output_cli_message("%s: %s.%s" % (t['target'], t['schema'], t['table']))
+                        print(output_cli_result(t['result'], compensation=12))
+
+    end_operation('uninstall')
+
+
+def _drop_unique_fields(db):
+    """
+    Drop the unique field from the tables of the database carrying it, on both clusters.
+
+    Return whether all the fields were dropped, None if already done by a previous run, and the list of the tables
+    along with the outcome.
+    """
+    if is_step_done('uninstall', 'drop_fields', 'Source', db):
+        return None, []
+
+    tables = []
 
+    def drop_fields():
+        for target in ['Source', 'Destination']:
+            db_conn = connect(target, db_name=db)
+            if not db_conn:
+                continue
+            for table in get_tables_with_field(db_conn, get_unique_field_name()):
+                table['target'] = target
+                table['result'] = drop_table_field(db_conn, table['schema'], table['table'], get_unique_field_name())
+                tables.append(table)
+        return all(t['result'] for t in tables)
 
+    return run_step('uninstall', 'drop_fields', drop_fields, 'Source', db)[0], tables
@@ -0,0 +1,156 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+from clint.textui import indent
+from ..helpers.docopt_dispatch import dispatch
+from ..helpers.replication import *
+from ..helpers.ui import *
+from ..helpers.utils import get_jobs, parallel_map
+from ..helpers.verify import *
+
+# Primary key values of the differing rows shown for each table
+SAMPLE_DIFFERENCES = 5
+
+
+@dispatch.on('verify')
+def verify(**kwargs):
+    jobs = get_jobs(kwargs)
+    try:
+        chunk_rows = int(kwargs.get('chunk_rows') or CHUNK_ROWS)
+        sample_rows = int(kwargs['sample']) if kwargs.get('sample') else None
+        if chunk_rows < 1 or (sample_rows is not None and sample_rows < 1):
+            raise ValueError
+    except ValueError:
+        puts(colored.red("Invalid chunk rows or sample size"))
+        sys.exit(1)
+
+    # Shortcut to ask master password before output Configuration message
+    decrypt(config().get('Source', 'password'))
+
+    try:
+        if sample_rows:
+            _verify_sample(jobs, sample_rows)
+        else:
+            _verify_chunks(jobs, chunk_rows)
+    finally:
+        close_verify_connections()
+
+
+def _verify_chunks(jobs, chunk_rows):
+    output_cli_message("Compare data of Source and Destination tables", color='cyan')
+    puts("")
+
+    failed = 0
+    with indent(4, quote=' >'):
+        # Tables are verified concurrently, results are printed in order
+        for (db, table), r in _iter_tables(lambda db, t: verify_table(db, t, chunk_rows), jobs):
+            with indent(4, quote=' '):
+                output_cli_message("%s.%s" % (table['schema'], table['table']))
+                if is_table_verified(table, r):
+                    print(output_cli_result(colored.green("%d rows" % r['source_rows']), 4))
+                    continue
+                failed += 1
+                print(output_cli_result(False, 4))
+                _output_differences(table, r)
+
+    output_cli_message("Tables with differences", color='cyan')
+    print(output_cli_result(failed == 0 or str(failed), compensation=-4))
+    if failed:
+        sys.exit(1)
+
+
+def _verify_sample(jobs, sample_rows):
+    output_cli_message("Compare a sample of the rows of Source and Destination tables", color='cyan')
+    puts("")
+    failed = 0
+    sampled = 0
+    with indent(4, quote=' >'):
+        for (db, table), r in _iter_tables(lambda db, t: sample_table(db, t, sample_rows), jobs):
+            with indent(4, quote=' '):
+                output_cli_message("%s.%s" % (table['schema'], table['table']))
+                sampled += r['sampled']
+                if not table['primary_key']:
+                    print(output_cli_result("Skipped, no primary key", 4))
+                elif r['error'] or r['missing'] or r['different']:
+                    failed += 1
+                    print(output_cli_result(False, 4))
+                    _output_differences(table, r)
+                else:
+                    print(output_cli_result(colored.green("%d rows, <%.2f%% differ" % (
+                        r['sampled'], 100 * get_differences_bound(r['units'])
+                    )), 4))
+
+    output_cli_message("Tables with differences", color='cyan')
+    print(output_cli_result(failed == 0 or str(failed), compensation=-4))
+    output_cli_message("Rows sampled", color='cyan')
+    print(output_cli_result(str(sampled), compensation=-4))
+    output_cli_message("Confidence level of the differing rows bounds", color='cyan')
+    print(output_cli_result("%d%%" % (100 * SAMPLE_CONFIDENCE), compensation=-4))
+    if failed:
+        sys.exit(1)
+
+
+def _iter_tables(function, jobs):
+    """
+    Run function(db, table) on the tables of all the Source databases concurrently.
+
+    Only the tables in the replication sets of the subscription are verified: the others, such as the pgl_ddl_deploy
+    bookkeeping tables and unlogged tables, aren't replicated. Yield ((db, table), result) in order, printing the name
+    of each database before its first table.
+    """
+    tables = []
+    for db in get_cluster_databases(connect('Source')):
+        replicated = get_replicated_tables(db)
+        if replicated is None:
+            output_cli_message(db)
+            print(output_cli_result("Skipped, no replication sets"))
+            continue
+        replicated = set((t['schema'], t['table']) for t in replicated)
+        tables.extend((db, t) for t in sorted(get_tables_primary_key(connect('Source', db_name=db)).values(),
+                                              key=lambda x: (x['schema'], x['table']))
+                      if (t['schema'], t['table']) in replicated)
+    current_db = None
+    for (db, table), r in parallel_map(lambda x: function(*x), tables, jobs):
+        if db != current_db:
+            output_cli_message(db)
+            print
+            current_db = db
+        yield (db, table), r
+
+
+def _output_differences(table, result):
+    with indent(4, quote=' '):
+        if result['error']:
+            output_hint(result['error'])
+            return
+        if 'sampled' in result:
+            output_cli_message("Sampled rows")
+            print(output_cli_result(str(result['sampled']), 8))
+        else:
+            if result['source_rows'] != result['destination_rows']:
+                output_cli_message("Rows on Source/Destination")
+                print(output_cli_result("%d/%d" % (result['source_rows'], result['destination_rows']), 8))
+            output_cli_message("Chunks with differences")
+            print(output_cli_result("%d of %d" % (len(result['mismatching_chunks']), result['chunks']), 8))
+        if not table['primary_key']:
+            output_hint("the table has no primary key, rows can't be compared one by one")
+            return
+        for key, description in [('missing', 'Missing on Destination'), ('extra', 'Only on Destination'),
+                                 ('different', 'Different')]:
+            if result.get(key):
+                output_cli_message(description)
+                print(output_cli_result(str(len(result[key])), 8))
+                output_hint("primary keys %s" % ", ".join(result[key][:SAMPLE_DIFFERENCES]))
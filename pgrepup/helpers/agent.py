@@ -0,0 +1,183 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import os
+import socket
+import stat
+import struct
+import time
+from ..config import get_tmp_folder
+
+# Environment variable overriding the path of the agent socket, like SSH_AUTH_SOCK for ssh-agent
+AGENT_SOCKET_ENV = 'PGREPUP_AGENT_SOCK'
+# Seconds a client waits for the agent before prompting for the master password
+AGENT_TIMEOUT = 1
+
+
+class AgentSocketError(Exception):
+    pass
+
+
+def get_agent_socket():
+    """
+    Return the path of the unix socket of the credential agent.
+
+    As for ssh-agent, the socket lives in a directory private to the user, so that a shared tmp folder can't be used
+    by other users to impersonate the agent.
+    """
+    return os.environ.get(AGENT_SOCKET_ENV) or os.path.join(
+        get_tmp_folder(), 'pgrepup-agent-%d' % os.getuid(), 'agent.sock'
+    )
+
+
+def _check_private(path, mode_check):
+    """Raise AgentSocketError unless path is owned by the current user and passes mode_check"""
+    st = os.lstat(path)
+    if st.st_uid != os.getuid() or not mode_check(st.st_mode):
+        raise AgentSocketError("%s is not private to the current user" % path)
+
+
+def _check_agent_socket(path):
+    _check_private(os.path.dirname(path), lambda m: stat.S_ISDIR(m) and not m & 0o077)
+    _check_private(path, stat.S_ISSOCK)
+
+
+def _check_peer(s):
+    """Raise AgentSocketError if the process listening on the socket belongs to another user (Linux only)"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return
+    credentials = s.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    if struct.unpack('3i', credentials)[1] != os.getuid():
+        raise AgentSocketError("the credential agent belongs to another user")
+
+
+def _request(message):
+    """Send message to the agent and return its reply, None if no agent of the current user is listening"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+
+    path = get_agent_socket()
+    try:
+        _check_agent_socket(path)
+    except (OSError, AgentSocketError):
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(AGENT_TIMEOUT)
+    try:
+        s.connect(path)
+        _check_peer(s)
+        s.sendall((message + "\n").encode('ascii'))
+        reply = b''
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            reply += data
+        return reply.strip()
+    except (socket.error, AgentSocketError):
+        return None
+    finally:
+        s.close()
+
+
+def get_agent_key(salt):
+    """Return the key derived with salt held by the agent, None if no agent holds it"""
+    return _request("KEY %s" % salt) or None
+
+
+def kill_agent():
+    """Ask the running agent to forget the key and exit, return False if no agent was listening"""
+    return _request("KILL") is not None
+
+
+def open_agent_socket():
+    """
+    Return the listening socket of a new agent.
+
+    The socket is created in a directory readable and writable only by the current user, as the ssh-agent one, so
+    that other users can't ask for the key. Raise AgentSocketError if the directory belongs to someone else.
+    """
+    path = get_agent_socket()
+    directory = os.path.dirname(path)
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise AgentSocketError("Unable to create the directory %s" % directory)
+    _check_private(directory, lambda m: stat.S_ISDIR(m) and not m & 0o077)
+
+    try:
+        if os.path.lexists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+    except (OSError, socket.error) as e:
+        raise AgentSocketError("Unable to listen on %s: %s" % (path, e))
+    server.listen(5)
+    return server
+
+
+def serve_key(server, key, salt, ttl):
+    """Hand out key to the clients of server until ttl seconds have passed or a KILL request is received"""
+    path = get_agent_socket()
+    expires = time.time() + ttl
+    try:
+        while True:
+            remaining = expires - time.time()
+            if remaining <= 0:
+                break
+            server.settimeout(remaining)
+            try:
+                conn = server.accept()[0]
+            except socket.timeout:
+                break
+            try:
+                if not _answer(conn, key, salt):
+                    break
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _answer(conn, key, salt):
+    """Answer a client request, return False when the agent has to exit"""
+    conn.settimeout(AGENT_TIMEOUT)
+    request = b''
+    try:
+        while not request.endswith(b'\n') and len(request) < 1024:
+            data = conn.recv(1024)
+            if not data:
+                break
+            request += data
+        request = request.decode('ascii', 'replace').strip()
+
+        if request == 'KILL':
+            conn.sendall(b'OK\n')
+            return False
+        # Keys derived with another salt belong to another configuration
+        if request == "KEY %s" % salt:
+            conn.sendall(key + b'\n')
+    except socket.error:
+        pass
+    return True
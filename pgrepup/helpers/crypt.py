@@ -18,6 +18,7 @@ import base64
 import getpass
 import os
 import sys
+import threading
 try:  # Python 2
     from ConfigParser import NoOptionError
 except ImportError:  # Python 3
@@ -28,10 +29,15 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.fernet import InvalidToken
 from ..config import config
+from .agent import get_agent_key
 
 
 this = sys.modules[__name__]
 this.key = None
+this.fernet = None
+# Decrypted values keyed by their encrypted form: get_connection_params decrypts the password on each connect()
+this.decrypted = {}
+this.lock = threading.RLock()
 
 
 def encrypt(string_to_encrypt):
@@ -39,8 +45,7 @@ def encrypt(string_to_encrypt):
     if not encrypted_passwords:
         return string_to_encrypt
 
-    f = Fernet(_get_key())
-    return f.encrypt(string_to_encrypt)
+    return _get_fernet().encrypt(string_to_encrypt)
 
 
 def decrypt(password):
@@ -48,31 +53,49 @@ def decrypt(password):
     if not encrypted_passwords:
         return password
 
-    try:
-        f = Fernet(_get_key())
-        return f.decrypt(password)
-    except InvalidToken:
-        print("Invalid master password")
-        sys.exit(-1)
+    with this.lock:
+        if password not in this.decrypted:
+            try:
+                this.decrypted[password] = _get_fernet().decrypt(password)
+            except InvalidToken:
+                print("Invalid master password")
+                sys.exit(-1)
+        return this.decrypted[password]
 
 
-def _get_key():
-    if this.key:
-        return this.key
+def _get_fernet():
+    with this.lock:
+        if this.fernet is None:
+            this.fernet = Fernet(get_key())
+        return this.fernet
+
+
+def get_key():
+    """
+    Return the key derived from the master password.
 
-    secret = getpass.getpass()
-    try:
-        salt = config().get('Security', 'salt')
-    except NoOptionError:
-        salt = base64.urlsafe_b64encode(os.urandom(16))
-        config().set('Security', 'salt', salt)
+    The key is asked to the credential agent first; the master password is prompted only if no agent holds it.
+    """
+    with this.lock:
+        if this.key:
+            return this.key
 
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100000,
-        backend=default_backend()
-    )
-    this.key = base64.urlsafe_b64encode(kdf.derive(secret))
-    return this.key
+        try:
+            salt = config().get('Security', 'salt')
+            this.key = get_agent_key(salt)
+            if this.key:
+                return this.key
+        except NoOptionError:
+            salt = base64.urlsafe_b64encode(os.urandom(16))
+            config().set('Security', 'salt', salt)
+
+        secret = getpass.getpass()
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=100000,
+            backend=default_backend()
+        )
+        this.key = base64.urlsafe_b64encode(kdf.derive(secret))
+        return this.key
@@ -17,6 +17,8 @@
 import hashlib
 import os
 import psycopg2
+import sys
+import threading
 import uuid
 try:  # Python 2
     import ConfigParser
@@ -30,6 +32,31 @@ from ..helpers.crypt import decrypt
 from ..helpers.crypt import encrypt
 
 
+this = sys.modules[__name__]
+# Pool of open connections keyed by (target, dbname), shared by all the helpers
+this.connections = {}
+this.connections_lock = threading.RLock()
+# Settings snapshots keyed by the dsn of the connection, so one per (target, dbname), see get_settings_snapshot()
+this.settings = {}
+
+# Settings fetched in a single round-trip by get_settings_snapshot()
+SNAPSHOT_SETTINGS = [
+    'hba_file',
+    'max_replication_slots',
+    'max_wal_senders',
+    'max_worker_processes',
+    'server_version',
+    'server_version_num',
+    'ssl',
+    'wal_level',
+]
+
+# Pages of a table filled in a single transaction by add_table_unique_field_online()
+FIX_BATCH_PAGES = 1000
+# SQLSTATE of the error raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+
+
 def get_dsn(database, db_name=None):
     return "host=%(host)s port=%(port)s dbname=%(dbname)s user=%(user)s password=%(password)s" \
            % get_connection_params(database, db_name)
@@ -54,13 +81,68 @@ def get_dsn_for_pglogical(database, db_name):
 
 
 def connect(database, db_name=None):
-    try:
-        conn = psycopg2.connect(get_dsn(database, db_name))
+    """
+    Return a connection to db_name (or to connect_database) of the given cluster.
+
+    Connections are pooled by (target, dbname): an already opened connection is reset (pending transaction rolled
+    back, autocommit disabled) and handed out again instead of opening a new backend.
+    Use close_connections() to release them.
+    """
+    key = (database, db_name if db_name else config().get(database, 'connect_database'))
+    with this.connections_lock:
+        conn = this.connections.get(key)
+        if conn is not None and not conn.closed:
+            try:
+                if not conn.autocommit:
+                    conn.rollback()
+                conn.autocommit = False
+                return conn
+            except psycopg2.Error:
+                conn.close()
+
+        this.connections.pop(key, None)
+        conn = open_connection(database, db_name)
+        if conn is not None:
+            this.connections[key] = conn
         return conn
+
+
+def open_connection(database, db_name=None):
+    """
+    Return a new connection to db_name (or to connect_database) of the given cluster, outside of the pool.
+
+    Use it when several threads work on the same database at the same time; the caller must close it.
+    """
+    try:
+        return psycopg2.connect(get_dsn(database, db_name))
     except psycopg2.DatabaseError:
         return None
 
 
+def close_connections(database=None):
+    """Close the pooled connections of the given cluster (all clusters if database is None)"""
+    with this.connections_lock:
+        for key in list(this.connections.keys()):
+            if database is not None and key[0] != database:
+                continue
+            conn = this.connections.pop(key)
+            if not conn.closed:
+                conn.close()
+
+
+def end_transactions(database=None):
+    """Roll back the transactions left open on the pooled connections of the given cluster (all if None)"""
+    with this.connections_lock:
+        for key, conn in this.connections.items():
+            if database is not None and key[0] != database:
+                continue
+            try:
+                if not conn.closed and not conn.autocommit:
+                    conn.rollback()
+            except psycopg2.Error:
+                pass
+
+
 def get_database_count(conn):
     try:
         cur = conn.cursor()
@@ -123,8 +205,26 @@ def drop_extension(conn, extension_name):
     return True
 
 
+def get_settings_snapshot(conn):
+    """
+    Return a dict with the values of SNAPSHOT_SETTINGS, fetched once per database and then cached.
+
+    The cache is keyed by the dsn of the connection, so that the connections opened outside of the pool share the
+    snapshot of the pooled one instead of adding an entry each.
+    """
+    snapshot = this.settings.get(conn.dsn)
+    if snapshot is None:
+        cur = conn.cursor()
+        cur.execute("SELECT name, setting FROM pg_settings WHERE name = ANY(%s);", [SNAPSHOT_SETTINGS])
+        snapshot = dict(cur.fetchall())
+        this.settings[conn.dsn] = snapshot
+    return snapshot
+
+
 def get_setting_value(conn, name):
     try:
+        if name in SNAPSHOT_SETTINGS:
+            return get_settings_snapshot(conn).get(name)
         cur = conn.cursor()
         cur.execute("SELECT setting FROM pg_settings WHERE name=%s;", [name])
         return cur.fetchone()[0]
@@ -132,7 +232,67 @@ def get_setting_value(conn, name):
         return None
 
 
+def get_active_sessions_count(conn):
+    """Return the number of sessions running a statement, excluding the current one"""
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM pg_stat_activity WHERE state = 'active' AND pid <> pg_backend_pid();")
+        return cur.fetchone()[0]
+    except psycopg2.Error:
+        return None
+
+
+def set_databases_read_only(conn, databases, read_only=True):
+    """
+    Set (or reset) default_transaction_read_only on the given databases. Return True if success
+
+    Only new sessions are affected: see get_client_sessions and terminate_sessions for the existing ones.
+    """
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        for db in databases:
+            cur.execute("SELECT quote_ident(%s)", [db])
+            db_ident = cur.fetchone()[0]
+            if read_only:
+                cur.execute("ALTER DATABASE %s SET default_transaction_read_only = on" % db_ident)
+            else:
+                cur.execute("ALTER DATABASE %s RESET default_transaction_read_only" % db_ident)
+        return True
+    except psycopg2.Error as e:
+        print(e)
+        return False
+
+
+def get_client_sessions(conn, databases):
+    """
+    Return the pids of the client sessions connected to the given databases, except the replication ones.
+
+    Before PostgreSQL 10 backend_type is missing: background processes as autovacuum workers are told apart by their
+    NULL client_port, which is -1 for clients connected through a unix socket.
+    """
+    cur = conn.cursor()
+    if int(get_setting_value(conn, 'server_version_num')) >= 100000:
+        client_backend = " AND backend_type = 'client backend'"
+    else:
+        client_backend = " AND client_port IS NOT NULL"
+    cur.execute(
+        "SELECT pid FROM pg_stat_activity WHERE datname = ANY(%s) AND pid <> pg_backend_pid() AND usename <> %s" +
+        client_backend,
+        [databases, get_pgrepup_replication_user()]
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def terminate_sessions(conn, pids):
+    """Terminate the sessions with the given pids, return the number of terminated sessions"""
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM unnest(%s::int[]) pid WHERE pg_terminate_backend(pid)", [pids])
+    return cur.fetchone()[0]
+
+
 def get_pg_hba_contents(conn):
+    """Return the lines of the pg_hba.conf file of the cluster, as one-column rows (None for empty lines)"""
     pg_hba_path = get_setting_value(conn, "hba_file")
     if not pg_hba_path:
         return None
@@ -141,13 +301,16 @@ def get_pg_hba_contents(conn):
         temp_table = "pghba_" + uuid.uuid4().hex
         cur = conn.cursor()
         cur.execute("CREATE TEMP TABLE " + temp_table + " (content text)")
-        cur.execute("COPY " + temp_table + " FROM %s", [pg_hba_path])
+        # Delimiter and quote can't occur in the file: tabs and backslashes are kept as they are
+        cur.execute("COPY " + temp_table + " FROM %s WITH (FORMAT csv, DELIMITER E'\\x01', QUOTE E'\\x02')",
+                    [pg_hba_path])
         cur.execute("SELECT * FROM " + temp_table + ";")
         rows = cur.fetchall()
         conn.rollback()
         return rows
     except psycopg2.Error as e:
         print(e)
+        conn.rollback()
         return None
 
 
@@ -271,6 +434,103 @@ def table_has_primary_key(db_conn, schema, table):
     return c.fetchone()[0] > 0
 
 
+def get_tables_primary_key(db_conn):
+    """
+    Return the tables of the database along with their estimated number of rows and their primary key columns.
+
+    A single catalog query is issued. The result is a dict keyed by schema.table; primary_key is the list of
+    (column, type) of the primary key in index order, empty if the table has no primary key.
+    """
+    c = db_conn.cursor()
+    c.execute("""
+    SELECT n.nspname, c.relname, c.reltuples::bigint,
+           array(
+               SELECT a.attname::text FROM pg_catalog.pg_index i, generate_subscripts(i.indkey, 1) k,
+                      pg_catalog.pg_attribute a
+               WHERE i.indrelid = c.oid AND i.indisprimary AND a.attrelid = c.oid AND a.attnum = i.indkey[k]
+               ORDER BY k
+           ),
+           array(
+               SELECT pg_catalog.format_type(a.atttypid, a.atttypmod)
+               FROM pg_catalog.pg_index i, generate_subscripts(i.indkey, 1) k, pg_catalog.pg_attribute a
+               WHERE i.indrelid = c.oid AND i.indisprimary AND a.attrelid = c.oid AND a.attnum = i.indkey[k]
+               ORDER BY k
+           )
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pglogical')
+    ORDER BY n.nspname, c.relname;
+    """)
+    result = {}
+    for r in c.fetchall():
+        result["%s.%s" % (r[0], r[1])] = {
+            'schema': r[0],
+            'table': r[1],
+            'rows': max(0, r[2]),
+            'primary_key': list(zip(r[3], r[4])),
+        }
+    return result
+
+
+def get_tables_size(db_conn):
+    """Return a dict with the size in bytes of the main fork of each table of the database, keyed by schema.table"""
+    c = db_conn.cursor()
+    c.execute("""
+    SELECT n.nspname, c.relname, pg_catalog.pg_relation_size(c.oid)
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pglogical');
+    """)
+    return dict(("%s.%s" % (r[0], r[1]), r[2]) for r in c.fetchall())
+
+
+def get_tables_replica_identity(db_conn):
+    """
+    Return all the tables of the database along with their primary key/replica identity status.
+
+    A single catalog query is issued. For each table the list of unique indexes that pglogical can use as replica
+    identity (valid, immediate, non partial unique indexes on NOT NULL columns only) is returned as well.
+    """
+    c = db_conn.cursor()
+    c.execute("""
+    SELECT n.nspname, c.relname,
+           COALESCE(bool_or(i.indisprimary), false),
+           COALESCE(bool_or(i.indisreplident AND c.relreplident = 'i'), false),
+           array_remove(array_agg(
+               CASE WHEN i.indisunique AND NOT i.indisprimary AND i.indisvalid AND i.indimmediate AND
+                         i.indpred IS NULL AND i.indexprs IS NULL AND
+                         NOT EXISTS (
+                             SELECT 1 FROM pg_catalog.pg_attribute a
+                             WHERE a.attrelid = c.oid AND a.attnum = ANY(i.indkey) AND NOT a.attnotnull
+                         )
+                    THEN ic.relname::text
+               END ORDER BY ic.relname
+           ), NULL)
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_catalog.pg_index i ON i.indrelid = c.oid
+    LEFT JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+    WHERE c.relkind IN ('r', 'p') AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'pglogical')
+    GROUP BY n.nspname, c.relname
+    ORDER BY n.nspname, c.relname;
+    """)
+    result = []
+    for r in c.fetchall():
+        result.append({
+            'schema': r[0],
+            'table': r[1],
+            'primary_key': r[2],
+            'replica_identity': r[3],
+            'unique_indexes': r[4] or [],
+        })
+    return result
+
+
+def table_has_replica_identity(table):
+    """Return True if the table returned by get_tables_replica_identity can be replicated by pglogical"""
+    return table['primary_key'] or table['replica_identity']
+
+
 def get_unique_field_name():
     return "__pgrepup_id"
 
@@ -283,15 +543,203 @@ def add_table_unique_index(db_conn, schema, table):
                   )
         db_conn.commit()
         return True
-    except psycopg2.Error:
+    except psycopg2.Error as e:
+        db_conn.rollback()
+        if e.pgcode == LOCK_NOT_AVAILABLE:
+            raise
+        return False
+
+
+def set_lock_timeout(db_conn, milliseconds):
+    """
+    Set the lock_timeout of the session, 0 disables it.
+
+    The helpers altering tables raise the psycopg2 error with pgcode LOCK_NOT_AVAILABLE when the timeout expires,
+    so that the caller can retry later.
+    """
+    autocommit = db_conn.autocommit
+    db_conn.autocommit = True
+    db_conn.cursor().execute("SET lock_timeout = %s", [int(milliseconds)])
+    db_conn.autocommit = autocommit
+
+
+def reset_lock_timeout(db_conn):
+    """Restore the lock_timeout of the session to the default of the role and database"""
+    autocommit = db_conn.autocommit
+    db_conn.autocommit = True
+    db_conn.cursor().execute("RESET lock_timeout")
+    db_conn.autocommit = autocommit
+
+
+def set_replica_identity_index(db_conn, schema, table, index):
+    """Use an existing unique index as replica identity of the table"""
+    try:
+        c = db_conn.cursor()
+        c.execute("SELECT format('ALTER TABLE %%I.%%I REPLICA IDENTITY USING INDEX %%I', %s, %s, %s)",
+                  [schema, table, index])
+        c.execute(c.fetchone()[0])
+        db_conn.commit()
+        return True
+    except psycopg2.Error as e:
         db_conn.rollback()
+        if e.pgcode == LOCK_NOT_AVAILABLE:
+            raise
         return False
 
 
+def add_table_unique_field_online(db_conn, schema, table, batch_pages=FIX_BATCH_PAGES):
+    """
+    Add the unique field to the table without rewriting it and without blocking writes for long.
+
+    The field is added nullable with a sequence default, so that new rows get a value. Existing rows are filled in
+    short transactions, batch_pages pages at a time by ctid, with session_replication_role set to replica so that the
+    triggers of the application don't fire. Then a unique index is built concurrently, the field is set NOT NULL and
+    the index is used as replica identity of the table. Since PostgreSQL 12 a validated check constraint saves the
+    scan of the table made by SET NOT NULL under exclusive lock; on older versions the scan can't be avoided, see
+    is_online_not_null_supported().
+    Every step is skipped if already done, so an interrupted run can be repeated (for instance after a lock timeout).
+    The lock_timeout of the session applies only to the brief exclusive locks of ALTER TABLE: the backfill, the index
+    build and the validation wait for the concurrent transactions as long as needed, since starting them over would
+    cost much more.
+    """
+    field = get_unique_field_name()
+    c = db_conn.cursor()
+    lock_timeout = None
+    replication_role = None
+    try:
+        c.execute("SELECT current_setting('lock_timeout'), current_setting('session_replication_role')")
+        lock_timeout, replication_role = c.fetchone()
+        c.execute("SELECT format('%%I.%%I', %s, %s)::regclass::oid, format('%%I.%%I', %s, %s), quote_ident(%s)",
+                  [schema, table, schema, table, schema])
+        oid, name, schema_name = c.fetchone()
+        sequence = "%s_seq_%d" % (field, oid)
+        index = "%s_idx_%d" % (field, oid)
+        constraint = "%s_not_null_%d" % (field, oid)
+
+        c.execute("SELECT 1 FROM pg_attribute WHERE attrelid = %s AND attname = %s AND NOT attisdropped", [oid, field])
+        if c.fetchone() is None:
+            # The sequence must be in the schema of the table to be owned by its column
+            c.execute("SELECT format('%%I.%%I', %s, %s), quote_literal(format('%%I.%%I', %s, %s))",
+                      [schema, sequence, schema, sequence])
+            sequence_name, sequence_literal = c.fetchone()
+            c.execute("CREATE SEQUENCE %s" % sequence_name)
+            c.execute("ALTER TABLE %s ADD COLUMN %s BIGINT" % (name, field))
+            c.execute("ALTER SEQUENCE %s OWNED BY %s.%s" % (sequence_name, name, field))
+            c.execute("ALTER TABLE %s ALTER COLUMN %s SET DEFAULT nextval(%s)" % (name, field, sequence_literal))
+        db_conn.commit()
+
+        db_conn.autocommit = True
+        c.execute("SET lock_timeout = 0")
+        # Filling the field is not a change of the application data: audit and updated_at triggers must not fire
+        c.execute("SET session_replication_role = replica")
+        c.execute("""
+            SELECT pg_relation_size(%s) / current_setting('block_size')::int,
+                   (current_setting('block_size')::int - 24) / 28
+        """, [oid])
+        pages, tuples_per_page = c.fetchone()
+        tid_range = int(get_setting_value(db_conn, 'server_version_num')) >= 140000
+        for first in range(0, pages, batch_pages):
+            last = min(first + batch_pages, pages) - 1
+            if tid_range:
+                c.execute(
+                    "UPDATE %s SET %s = DEFAULT WHERE ctid >= %%s::tid AND ctid < %%s::tid AND %s IS NULL"
+                    % (name, field, field),
+                    ["(%d,0)" % first, "(%d,0)" % (last + 1)]
+                )
+            else:
+                c.execute("""
+                    UPDATE %s SET %s = DEFAULT WHERE %s IS NULL AND ctid = ANY(ARRAY(
+                        SELECT ('(' || p || ',' || i || ')')::tid
+                        FROM generate_series(%%s, %%s) p, generate_series(1, %%s) i
+                    ))
+                """ % (name, field, field), [first, last, tuples_per_page])
+
+        # Rows updated during the backfill may have moved to pages already processed
+        while True:
+            c.execute("""
+                UPDATE %s SET %s = DEFAULT
+                WHERE ctid = ANY(ARRAY(SELECT ctid FROM %s WHERE %s IS NULL LIMIT %%s))
+            """ % (name, field, name, field), [tuples_per_page * batch_pages])
+            if c.rowcount == 0:
+                break
+        c.execute("SELECT set_config('session_replication_role', %s, false)", [replication_role])
+
+        # An index left invalid by an interrupted build has to be dropped
+        c.execute("""
+            SELECT i.indisvalid FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+            WHERE i.indrelid = %s AND ic.relname = %s
+        """, [oid, index])
+        r = c.fetchone()
+        if r is not None and not r[0]:
+            c.execute("DROP INDEX CONCURRENTLY %s.%s" % (schema_name, index))
+        if r is None or not r[0]:
+            c.execute("CREATE UNIQUE INDEX CONCURRENTLY %s ON %s (%s)" % (index, name, field))
+
+        c.execute("SELECT set_config('lock_timeout', %s, false)", [lock_timeout])
+        if is_online_not_null_supported(db_conn):
+            c.execute("ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s" % (name, constraint))
+            c.execute("ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) NOT VALID" % (name, constraint, field))
+            c.execute("SET lock_timeout = 0")
+            c.execute("ALTER TABLE %s VALIDATE CONSTRAINT %s" % (name, constraint))
+            c.execute("SELECT set_config('lock_timeout', %s, false)", [lock_timeout])
+            c.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (name, field))
+            c.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (name, constraint))
+        else:
+            c.execute("ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (name, field))
+        c.execute("ALTER TABLE %s REPLICA IDENTITY USING INDEX %s" % (name, index))
+        return True
+    except psycopg2.Error as e:
+        if not db_conn.autocommit:
+            db_conn.rollback()
+        if e.pgcode == LOCK_NOT_AVAILABLE:
+            raise
+        return False
+    finally:
+        db_conn.autocommit = True
+        try:
+            if lock_timeout is not None:
+                c.execute("SELECT set_config('lock_timeout', %s, false)", [lock_timeout])
+            if replication_role is not None:
+                c.execute("SELECT set_config('session_replication_role', %s, false)", [replication_role])
+        except psycopg2.Error:
+            pass
+        db_conn.autocommit = False
+
+
+def is_online_not_null_supported(db_conn):
+    """
+    Return True if SET NOT NULL can use a validated check constraint instead of scanning the table (PostgreSQL 12+).
+
+    On older versions add_table_unique_field_online() still scans the table under ACCESS EXCLUSIVE lock to set the
+    field NOT NULL, which the replica identity index requires.
+    """
+    return int(get_setting_value(db_conn, 'server_version_num')) >= 120000
+
+
+def get_tables_with_field(db_conn, field):
+    """
+    Return the tables of the database having a column named field, with a single catalog query.
+
+    Inheritance and partition children whose column comes from the parent are skipped: dropping it from the parent
+    drops it from them too.
+    """
+    c = db_conn.cursor()
+    c.execute("""
+    SELECT n.nspname, c.relname
+    FROM pg_catalog.pg_attribute a
+    JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+    JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+    WHERE a.attname = %s AND NOT a.attisdropped AND a.attinhcount = 0 AND c.relkind IN ('r', 'p')
+    ORDER BY n.nspname, c.relname;
+    """, [field])
+    return [{'schema': r[0], 'table': r[1]} for r in c.fetchall()]
+
+
 def drop_table_field(db_conn, schema, table, field):
     try:
         c = db_conn.cursor()
-        c.execute("ALTER TABLE %s.%s DROP COLUMN IF EXISTS %s" % (schema, table, field))
+        c.execute("SELECT format('ALTER TABLE %%I.%%I DROP COLUMN IF EXISTS %%I', %s, %s, %s)", [schema, table, field])
+        c.execute(c.fetchone()[0])
         db_conn.commit()
         return True
     except psycopg2.Error:
@@ -0,0 +1,310 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import binascii
+import socket
+import sys
+import threading
+import psycopg2
+from .database import get_pg_hba_contents, get_setting_value
+
+this = sys.modules[__name__]
+# Parsed rules keyed by the dsn of the connection they were read from, see get_hba_rules()
+this.rules = {}
+this.rules_lock = threading.Lock()
+
+# Authentication methods accepting the password pgrepup puts in the pglogical dsn
+PASSWORD_METHODS = ['trust', 'password', 'md5', 'scram-sha-256']
+
+# Prefix length of the networks assumed for samenet: the netmasks of the server interfaces are not visible from SQL
+SAMENET_PREFIX = {32: 24, 128: 64}
+
+
+def get_hba_rules(conn):
+    """
+    Return the rules of the pg_hba.conf of the cluster, in file order, or None if they can't be read.
+
+    Each rule is a dict with type, databases, users, address, network (a (bits, address, mask) tuple for IP rules)
+    and method. The rules are read from pg_hba_file_rules on 10+ and parsed from the file on older versions, once per
+    cluster and run.
+    """
+    with this.rules_lock:
+        if conn.dsn not in this.rules:
+            if int(get_setting_value(conn, 'server_version_num')) >= 100000:
+                this.rules[conn.dsn] = _read_hba_view(conn)
+            else:
+                this.rules[conn.dsn] = _read_hba_file(conn)
+        return this.rules[conn.dsn]
+
+
+def _read_hba_view(conn):
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT type, database, user_name, address, netmask, auth_method
+            FROM pg_hba_file_rules
+            WHERE error IS NULL
+            ORDER BY line_number
+        """)
+        rows = cur.fetchall()
+        conn.rollback()
+    except psycopg2.Error as e:
+        print(e)
+        conn.rollback()
+        return None
+
+    return [_make_rule(r[0], r[1], r[2], r[3], r[4], r[5]) for r in rows]
+
+
+def _read_hba_file(conn):
+    rows = get_pg_hba_contents(conn)
+    if rows is None:
+        return None
+
+    rules = []
+    for r in rows:
+        fields = _split_fields(r[0] or '')
+        if not fields:
+            continue
+        rule_type = fields[0][0]
+        if rule_type == 'local' and len(fields) >= 4:
+            rules.append(_make_rule(rule_type, fields[1], fields[2], None, None, fields[3][0]))
+        elif rule_type.startswith('host') and len(fields) >= 5:
+            address = fields[3][0]
+            if _parse_ip(address) and len(fields) >= 6 and _parse_ip(fields[4][0]):
+                rules.append(_make_rule(rule_type, fields[1], fields[2], address, fields[4][0], fields[5][0]))
+            else:
+                rules.append(_make_rule(rule_type, fields[1], fields[2], address, None, fields[4][0]))
+    return rules
+
+
+def _split_fields(line):
+    """Split a pg_hba.conf line into its fields, each one being the list of its comma separated items"""
+    fields = []
+    items = []
+    item = ''
+    quoted = False
+    for c in line + ' ':
+        if c == '"':
+            quoted = not quoted
+        elif quoted:
+            item += c
+        elif c == '#':
+            break
+        elif c == ',':
+            items.append(item)
+            item = ''
+        elif c.isspace():
+            if item or items:
+                fields.append(items + [item])
+            items = []
+            item = ''
+        else:
+            item += c
+    if item or items:
+        fields.append(items + [item])
+    return fields
+
+
+def _make_rule(rule_type, databases, users, address, netmask, method):
+    return {
+        'type': rule_type,
+        'databases': databases,
+        'users': users,
+        'address': address,
+        'network': _parse_network(address, netmask) if address else None,
+        'method': method,
+    }
+
+
+def _parse_ip(text):
+    """Return the (bits, address) tuple of an IPv4 or IPv6 address, None if text is not an address"""
+    for family, bits in [(socket.AF_INET, 32), (socket.AF_INET6, 128)]:
+        try:
+            return bits, int(binascii.hexlify(socket.inet_pton(family, text)), 16)
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+def _parse_network(address, netmask):
+    """Return the (bits, network, mask) tuple of a CIDR or address/netmask pair, None for keywords and host names"""
+    prefix = None
+    if '/' in address:
+        address, prefix = address.split('/', 1)
+    ip = _parse_ip(address)
+    if ip is None:
+        return None
+
+    bits, value = ip
+    full = (1 << bits) - 1
+    if prefix is not None:
+        try:
+            mask = full ^ ((1 << (bits - int(prefix))) - 1)
+        except ValueError:
+            return None
+    elif netmask:
+        mask = _parse_ip(netmask)
+        if mask is None or mask[0] != bits:
+            return None
+        mask = mask[1]
+    else:
+        mask = full
+    return bits, value & mask, mask
+
+
+def resolve_host(host):
+    """Return the (bits, address) tuples of the addresses host resolves to"""
+    ip = _parse_ip(host)
+    if ip:
+        return [ip]
+    try:
+        addresses = set(a[4][0].split('%')[0] for a in socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM))
+    except socket.error:
+        return []
+    return [ip for ip in [_parse_ip(a) for a in addresses] if ip]
+
+
+def find_hba_rule(rules, database, user, client, client_host=None, roles=None, ssl=False, server=None,
+                  replication=False):
+    """
+    Return the first rule of rules matching a TCP/IP connection, as the server does, or None if no rule matches.
+
+    client is the (bits, address) tuple of the client address and client_host the name it was resolved from. roles are
+    the roles user is member of, ssl tells whether the connection is encrypted and server is the (bits, address) tuple
+    of the server address, used for samehost and samenet. A replication connection is a physical replication one,
+    only matched by the replication keyword.
+    """
+    roles = roles or [user]
+    for rule in rules:
+        if not _match_type(rule['type'], ssl):
+            continue
+        if not _match_database(rule['databases'], database, user, roles, replication):
+            continue
+        if not _match_user(rule['users'], user, roles):
+            continue
+        if not _match_address(rule, client, client_host, server):
+            continue
+        return rule
+    return None
+
+
+def is_password_rule(rule):
+    """Return True if the rule lets in a client authenticating with the password of the pglogical dsn"""
+    return rule is not None and rule['method'] in PASSWORD_METHODS
+
+
+def _match_type(rule_type, ssl):
+    if rule_type in ('host', 'hostnogssenc'):
+        return True
+    if rule_type == 'hostssl':
+        return ssl
+    if rule_type == 'hostnossl':
+        return not ssl
+    # local rules don't apply to TCP/IP connections and libpq doesn't request GSSAPI encryption without credentials
+    return False
+
+
+def _match_database(databases, database, user, roles, replication):
+    for d in databases:
+        if replication:
+            if d == 'replication':
+                return True
+        elif d == 'all' or d == database:
+            return True
+        elif d == 'sameuser' and database == user:
+            return True
+        elif d in ('samerole', 'samegroup') and database in roles:
+            return True
+    return False
+
+
+def _match_user(users, user, roles):
+    for u in users:
+        if u == 'all' or u == user:
+            return True
+        if u.startswith('+') and u[1:] in roles:
+            return True
+    return False
+
+
+def _match_address(rule, client, client_host, server):
+    address = rule['address']
+    if rule['network']:
+        bits, network, mask = rule['network']
+        return client[0] == bits and client[1] & mask == network
+    if address == 'all':
+        return True
+    if address == 'samehost':
+        return server is not None and client == server
+    if address == 'samenet':
+        if server is None or server[0] != client[0]:
+            return False
+        mask = ((1 << client[0]) - 1) ^ ((1 << (client[0] - SAMENET_PREFIX[client[0]])) - 1)
+        return client[1] & mask == server[1] & mask
+    if address.startswith('.'):
+        return client_host is not None and client_host.endswith(address)
+    return client in resolve_host(address)
+
+
+def get_role_memberships(conn, user):
+    """Return the roles user is member of, including itself, or [user] if the role doesn't exist yet"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT r.rolname
+        FROM pg_roles u, pg_roles r
+        WHERE u.rolname = %s AND pg_has_role(u.oid, r.oid, 'MEMBER')
+    """, [user])
+    return [r[0] for r in cur.fetchall()] or [user]
+
+
+def get_server_address(conn):
+    """Return the (bits, address) tuple of the server address of the connection, None on unix sockets"""
+    cur = conn.cursor()
+    cur.execute("SELECT host(inet_server_addr())")
+    address = cur.fetchone()[0]
+    return _parse_ip(address) if address else None
+
+
+def check_hba_access(conn, host, user, databases):
+    """
+    Evaluate the pg_hba.conf rules of the cluster for the connections opened by pglogical from host as user.
+
+    Return a dict telling whether the replication connection and the connections to all the databases get a password
+    rule, or None if the rules can't be read. On 10+ logical replication connections are matched by database name
+    like normal ones, before they are matched by the replication keyword.
+    """
+    rules = get_hba_rules(conn)
+    if rules is None:
+        return None
+
+    roles = get_role_memberships(conn, user)
+    server = get_server_address(conn)
+    ssl = get_setting_value(conn, 'ssl') == 'on'
+    clients = resolve_host(host)
+
+    def allowed(database, replication=False):
+        return any(
+            is_password_rule(find_hba_rule(rules, database, user, c, host, roles, ssl, server, replication))
+            for c in clients
+        )
+
+    connection = all(allowed(d) for d in databases)
+    if int(get_setting_value(conn, 'server_version_num')) >= 100000:
+        replication = connection
+    else:
+        replication = allowed(None, replication=True)
+    return {'replication': replication, 'connection': connection}
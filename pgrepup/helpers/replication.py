@@ -14,12 +14,18 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
-import re
 from .database import *
-from time import sleep
+from .utils import parallel_map, wait_until
 from psycopg2 import Error
 from psycopg2 import extras
 
+# Seconds to wait for pglogical to drop a subscription or a node
+DROP_TIMEOUT = 60
+# Sequences synchronized in a single transaction
+SEQUENCE_BATCH_SIZE = 1000
+# Replication sets the subscription of each database receives, the pglogical defaults
+SUBSCRIPTION_REPLICATION_SETS = ['default', 'default_insert_only', 'ddl_sql']
+
 
 def check_destination_subscriptions():
     """Return True if there are active subscriptions in destination database"""
@@ -31,66 +37,97 @@ def check_destination_subscriptions():
     return result
 
 
-def get_destination_subscriptions():
+def get_destination_subscriptions(jobs=1):
     """Return hash with dbname and boolean as value (True if subscription is in progress)"""
 
-    result = {}
     conn = connect('Destination')
-    for db in get_cluster_databases(conn):
-        db_conn = connect('Destination', db_name=db)
-        result[db] = False
-        try:
-            cur = db_conn.cursor()
-            cur.execute("SELECT status FROM pglogical.show_subscription_status(subscription_name := 'subscription');")
-            for r in cur.fetchall():
-                if r[0] == 'replicating' or 'down':
-                    result[db] = True
-        except psycopg2.InternalError:
-            result[db] = False
-        except psycopg2.OperationalError:
-            result[db] = False
-        except psycopg2.ProgrammingError:
-            result[db] = False
+    return dict(parallel_map(has_subscription, get_cluster_databases(conn), jobs))
+
+
+def has_subscription(db):
+    """Return True if the subscription of the given Destination database is in progress"""
+    db_conn = connect('Destination', db_name=db)
+    result = False
+    try:
+        cur = db_conn.cursor()
+        cur.execute("SELECT status FROM pglogical.show_subscription_status(subscription_name := 'subscription');")
+        for r in cur.fetchall():
+            if r[0] == 'replicating' or 'down':
+                result = True
+    except psycopg2.InternalError:
+        result = False
+    except psycopg2.OperationalError:
+        result = False
+    except psycopg2.ProgrammingError:
+        result = False
 
     return result
 
 
-def stop_subscription(db):
-    """Stop subscription in given database. Return True if success"""
+def stop_subscription(db, timeout=DROP_TIMEOUT, wait_workers=False):
+    """
+    Stop subscription in given database. Return True if success
+
+    With wait_workers, wait also for the pglogical workers of the database to exit, where they can be seen (see
+    count_pglogical_workers()).
+    """
     db_conn = connect('Destination', db_name=db)
     db_conn.autocommit = True
     cur = db_conn.cursor()
+
+    def dropped():
+        cur.execute(
+            "SELECT * FROM pglogical.drop_subscription(subscription_name := %s, ifexists := true)",
+            ['subscription']
+        )
+        return cur.fetchone()[0] == 0
+
     try:
-        while True:
-            cur.execute(
-                "SELECT * FROM pglogical.drop_subscription(subscription_name := %s, ifexists := true)",
-                ['subscription']
-            )
-            if cur.fetchone()[0] == 0:
-                break
-            sleep(1)
+        if not wait_until(dropped, timeout):
+            return False
+        if wait_workers:
+            return wait_until(lambda: not count_pglogical_workers(db_conn), timeout)
     except Error:
         return False
     return True
 
 
-def drop_node(db):
+def drop_node(db, timeout=DROP_TIMEOUT):
     """Stop all background workers of pglogical"""
 
     db_conn = connect('Destination', db_name=db)
     db_conn.autocommit = True
     cur = db_conn.cursor()
-    while True:
+
+    def dropped():
         try:
             cur.execute("SELECT * FROM pglogical.drop_node(node_name := 'Destination', ifexists := true);")
         except psycopg2.ProgrammingError:
-            break
-        if not cur.fetchone()[0]:
-            break
-        sleep(1)
+            return True
+        return not cur.fetchone()[0]
+
+    return wait_until(dropped, timeout)
+
+
+def count_pglogical_workers(db_conn):
+    """
+    Return the number of pglogical background workers connected to the database, None if they can't be seen.
+
+    pg_stat_activity names the pglogical workers since PostgreSQL 11. PostgreSQL 10 lists them as generic background
+    workers, so any background worker of the database is counted. Before 10 background workers aren't listed at all.
+    """
+    version = int(get_setting_value(db_conn, 'server_version_num'))
+    if version < 100000:
+        return None
+    cur = db_conn.cursor()
+    cur.execute("""
+        SELECT COUNT(*) FROM pg_stat_activity
+        WHERE datname = current_database() AND pid <> pg_backend_pid() AND backend_type LIKE %s
+    """, ['pglogical%' if version >= 110000 else 'background worker'])
+    return cur.fetchone()[0]
 
 
-def start_subscription(db):
+def start_subscription(db, synchronize_data=True):
     db_conn = connect('Destination', db)
     db_conn.autocommit = True
     try:
@@ -100,22 +137,181 @@ def start_subscription(db):
             SELECT pglogical.create_subscription(
                                     subscription_name := 'subscription',
                                     synchronize_structure := false,
-                                    synchronize_data := true,
+                                    synchronize_data := %s,
+                                    replication_sets := %s,
                                     provider_dsn := %s
             );
             """,
-            [get_dsn_for_pglogical('Source', db)]
+            [synchronize_data, SUBSCRIPTION_REPLICATION_SETS, get_dsn_for_pglogical('Source', db)]
         )
         return True
     except Error:
         return False
 
 
-def syncronize_sequences(db):
+def resynchronize_table(db, schema, table):
+    """Ask pglogical to copy again the data of a table. The table is truncated immediately"""
+    db_conn = connect('Destination', db)
+    db_conn.autocommit = True
+    try:
+        c = db_conn.cursor()
+        c.execute(
+            "SELECT pglogical.alter_subscription_resynchronize_table(%s, format('%%I.%%I', %s, %s)::regclass)",
+            ['subscription', schema, table]
+        )
+        return True
+    except Error as e:
+        print(e)
+        return False
+
+
+def syncronize_sequences(db, batch_size=SEQUENCE_BATCH_SIZE):
+    """
+    Queue the current value of every replicated sequence of the Source database to Destination.
+
+    Sequences are synchronized batch_size at a time, each batch in its own transaction.
+    Return the number of synchronized sequences or None on error.
+    """
     db_conn = connect('Source', db)
     db_conn.autocommit = True
     c = db_conn.cursor()
-    c.execute("SELECT pglogical.synchronize_sequence( seqoid ) FROM pglogical.sequence_state")
+    try:
+        # The database may have been frozen by switchover
+        c.execute("SET default_transaction_read_only = off")
+        c.execute("SELECT seqoid::oid FROM pglogical.sequence_state ORDER BY seqoid")
+        sequences = [r[0] for r in c.fetchall()]
+        for i in range(0, len(sequences), batch_size):
+            c.execute(
+                "SELECT pglogical.synchronize_sequence(s) FROM unnest(%s::oid[]) s",
+                [sequences[i:i + batch_size]]
+            )
+    except Error:
+        return None
+    return len(sequences)
+
+
+def get_replicated_sequences(db):
+    """Return the "schema.sequence" names of the sequences in a replication set of the Source database"""
+    db_conn = connect('Source', db_name=db)
+    cur = db_conn.cursor()
+    try:
+        cur.execute("""
+            SELECT DISTINCT n.nspname || '.' || c.relname
+            FROM pglogical.replication_set_seq r
+            JOIN pg_class c ON c.oid = r.set_seqoid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+        """)
+        sequences = [r[0] for r in cur.fetchall()]
+        db_conn.rollback()
+        return sequences
+    except Error:
+        db_conn.rollback()
+        return None
+
+
+def get_replicated_tables(db):
+    """Return the tables of the Source database in the replication sets of the subscription, None on failure"""
+    db_conn = connect('Source', db_name=db)
+    cur = db_conn.cursor()
+    try:
+        cur.execute("""
+            SELECT DISTINCT n.nspname, c.relname
+            FROM pglogical.replication_set_table t
+            JOIN pglogical.replication_set s ON s.set_id = t.set_id
+            JOIN pg_class c ON c.oid = t.set_reloid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE s.set_name = ANY(%s)
+            ORDER BY n.nspname, c.relname
+        """, [SUBSCRIPTION_REPLICATION_SETS])
+        tables = [{'schema': r[0], 'table': r[1]} for r in cur.fetchall()]
+        db_conn.rollback()
+        return tables
+    except Error:
+        db_conn.rollback()
+        return None
+
+
+def get_sequences_values(target, db, sequences):
+    """Return the last_value of the given "schema.sequence" sequences of the database as a {name: value} dict"""
+    db_conn = connect(target, db_name=db)
+    cur = db_conn.cursor()
+    try:
+        if int(get_setting_value(db_conn, 'server_version_num')) >= 100000:
+            cur.execute("""
+                SELECT schemaname || '.' || sequencename, last_value FROM pg_sequences
+                WHERE schemaname || '.' || sequencename = ANY(%s)
+            """, [sequences])
+        else:
+            # Before PostgreSQL 10 the value is stored only in the sequence itself: read all of them in one query
+            cur.execute("""
+                SELECT string_agg(
+                    format(
+                        'SELECT %%L::text, last_value FROM %%I.%%I', n.nspname || '.' || c.relname, n.nspname, c.relname
+                    ),
+                    ' UNION ALL '
+                )
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE c.relkind = 'S' AND n.nspname || '.' || c.relname = ANY(%s)
+            """, [sequences])
+            query = cur.fetchone()[0]
+            if not query:
+                return {}
+            cur.execute(query)
+        values = dict(cur.fetchall())
+        db_conn.rollback()
+        return values
+    except Error:
+        db_conn.rollback()
+        return None
+
+
+def get_lagging_sequences(db, sequences=None):
+    """
+    Return the replicated sequences whose value on Destination is behind Source, as a list of dicts with keys
+    sequence, source and destination. Return None if the values can't be read.
+
+    Sequences that aren't in a replication set, like the ones of pgl_ddl_deploy, are never synchronized and are not
+    compared. sequences is the list returned by get_replicated_sequences(), read again if None.
+    """
+    if sequences is None:
+        sequences = get_replicated_sequences(db)
+    if sequences is None:
+        return None
+    if not sequences:
+        return []
+
+    source = get_sequences_values('Source', db, sequences)
+    destination = get_sequences_values('Destination', db, sequences)
+    if source is None or destination is None:
+        return None
+
+    lagging = []
+    for sequence in sorted(source.keys()):
+        src_value = source[sequence]
+        dest_value = destination.get(sequence)
+        if src_value is not None and (dest_value is None or dest_value < src_value):
+            lagging.append({'sequence': sequence, 'source': src_value, 'destination': dest_value})
+    return lagging
+
+
+def synchronize_and_verify_sequences(db, timeout=DROP_TIMEOUT):
+    """
+    Synchronize the sequences of the database and wait for Destination to apply them.
+
+    Return the number of synchronized sequences and the ones still lagging (see get_lagging_sequences).
+    """
+    count = syncronize_sequences(db)
+    if count is None:
+        return None, None
+    sequences = get_replicated_sequences(db)
+    lagging = [None]
+
+    def applied():
+        lagging[0] = get_lagging_sequences(db, sequences)
+        return lagging[0] == []
+
+    wait_until(applied, timeout)
+    return count, lagging[0]
 
 
 def setup_pgl_ddl_deploy(db, target):
@@ -165,11 +361,15 @@ def setup_pgl_ddl_deploy(db, target):
 
 def clean_pgl_ddl_deploy(target, db):
     db_conn = connect(target, db)
-    db_conn.autocommit = True
-    c = db_conn.cursor()
-    c.execute("SELECT pgl_ddl_deploy.undeploy(set_name) FROM pgl_ddl_deploy.set_configs")
     if not db_conn:
         return False
+    db_conn.autocommit = True
+    c = db_conn.cursor()
+    try:
+        c.execute("SELECT pgl_ddl_deploy.undeploy(set_name) FROM pgl_ddl_deploy.set_configs")
+    except Error:
+        # pgl_ddl_deploy is not installed in the database
+        pass
     if not drop_extension(db_conn, "pgl_ddl_deploy"):
         return False
 
@@ -291,6 +491,36 @@ def get_setup_result(target, db):
         return False
 
 
+def is_database_set_up(target, db):
+    """
+    Return True if the database is already configured by setup: the pglogical node and the pgl_ddl_deploy extension
+    exist, the stored setup result is successful and, on Source, all the permanent tables are in a replication set
+    (unlogged and temporary tables are never replicated).
+    """
+    db_conn = connect(target, db)
+    if not db_conn:
+        return False
+    db_conn.autocommit = True
+    try:
+        c = db_conn.cursor()
+        c.execute("""
+            SELECT
+                EXISTS (SELECT 1 FROM pglogical.node WHERE node_name = %s),
+                EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pgl_ddl_deploy'),
+                (SELECT bool_and(result) FROM pglogical.pgrepup_setup),
+                NOT EXISTS (
+                    SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE c.relkind = 'r' AND c.relpersistence = 'p' AND
+                          n.nspname !~ '^(pg_.*|pglogical|pglogical_origin|pgl_ddl_deploy|information_schema)$' AND
+                          c.oid NOT IN (SELECT set_reloid FROM pglogical.replication_set_table)
+                )
+        """, [target])
+        node, ddl_deploy, result, all_tables = c.fetchone()
+        return bool(node and ddl_deploy and result and (all_tables or target == 'Destination'))
+    except Error:
+        return False
+
+
 def get_replication_status(db):
     result = {"result": False, "status": None}
     db_conn = connect('Destination', db_name=db)
@@ -310,6 +540,91 @@ def get_replication_status(db):
     return result
 
 
+def get_tables_sync_status(db):
+    """
+    Return the initial synchronization status of the tables of the subscription in the given Destination database.
+
+    The status is one of the sync_status codes of pglogical.local_sync_status, see is_table_synchronized().
+    """
+    db_conn = connect('Destination', db_name=db)
+    if not db_conn:
+        return []
+    try:
+        cur = db_conn.cursor()
+        cur.execute("""
+            SELECT sync_nspname, sync_relname, sync_status
+            FROM pglogical.local_sync_status
+            WHERE sync_relname IS NOT NULL
+            ORDER BY sync_nspname, sync_relname
+        """)
+        return [{'schema': r[0], 'table': r[1], 'status': r[2]} for r in cur.fetchall()]
+    except Error:
+        db_conn.rollback()
+        return []
+
+
+def get_subscription_sync_status(db):
+    """
+    Return the initial synchronization status of the subscription as a whole, None if there is no subscription.
+
+    The status is returned in the format of get_tables_sync_status(), with None schema and table. It covers the copy
+    of all the tables started by a subscription created with synchronize_data: the tables get a status of their own
+    only once it's complete.
+    """
+    db_conn = connect('Destination', db_name=db)
+    if not db_conn:
+        return None
+    try:
+        cur = db_conn.cursor()
+        cur.execute("SELECT sync_status FROM pglogical.local_sync_status WHERE sync_relname IS NULL")
+        r = cur.fetchone()
+        return {'schema': None, 'table': None, 'status': r[0]} if r else None
+    except Error:
+        db_conn.rollback()
+        return None
+
+
+def is_table_synchronized(table):
+    """Return True if pglogical completed the initial copy of a table returned by get_tables_sync_status"""
+    # y: synchronized, r: ready
+    return table['status'] in ('y', 'r')
+
+
+def get_sync_progress(db):
+    """
+    Return the initial copy progress of the tables of a database.
+
+    Each table returned by get_tables_sync_status() is enriched with its size on Source and Destination. While the
+    subscription is still copying all the data, the tables of its replication sets without a status of their own
+    take the status of the subscription.
+    """
+    tables = get_tables_sync_status(db)
+    subscription = get_subscription_sync_status(db)
+    if subscription and not is_table_synchronized(subscription):
+        listed = set((t['schema'], t['table']) for t in tables)
+        for t in get_replicated_tables(db) or []:
+            if (t['schema'], t['table']) not in listed:
+                tables.append({'schema': t['schema'], 'table': t['table'], 'status': subscription['status']})
+        tables.sort(key=lambda t: (t['schema'], t['table']))
+    if not tables:
+        return tables
+
+    source_sizes = get_tables_size(connect('Source', db_name=db))
+    destination_sizes = get_tables_size(connect('Destination', db_name=db))
+    for t in tables:
+        name = "%s.%s" % (t['schema'], t['table'])
+        t['source_size'] = source_sizes.get(name, 0)
+        t['destination_size'] = destination_sizes.get(name, 0)
+    return tables
+
+
+def get_wal_functions(conn):
+    """Return the names of the (current position, position difference) WAL functions of the server"""
+    if int(get_setting_value(conn, 'server_version_num')) >= 100000:
+        return 'pg_current_wal_lsn', 'pg_wal_lsn_diff'
+    return 'pg_current_xlog_location', 'pg_xlog_location_diff'
+
+
 def get_replication_delay():
     db_conn = connect('Destination')
     src_db_conn = connect('Source')
@@ -319,12 +634,47 @@ def get_replication_delay():
     dest_cur.execute("SELECT remote_lsn FROM pg_replication_origin_status ORDER BY remote_lsn DESC limit 1;")
     d_lsn_r = dest_cur.fetchone()
     if d_lsn_r:
-        src_db_version = get_postgresql_version(src_db_conn)
-        if re.match('^10', src_db_version):
-            src_cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", [d_lsn_r[0]])
-        else:
-            src_cur.execute("SELECT pg_xlog_location_diff(pg_current_xlog_location(), %s)", [d_lsn_r[0]])
+        current_lsn, lsn_diff = get_wal_functions(src_db_conn)
+        src_cur.execute("SELECT %s(%s(), %%s)" % (lsn_diff, current_lsn), [d_lsn_r[0]])
         diff = src_cur.fetchone()
         return diff
     else:
         return False
+
+
+def get_current_lsn(conn):
+    """Return the current WAL position of the cluster in bytes"""
+    current_lsn, lsn_diff = get_wal_functions(conn)
+    cur = conn.cursor()
+    cur.execute("SELECT %s(%s(), '0/0')" % (lsn_diff, current_lsn))
+    return int(cur.fetchone()[0])
+
+
+def get_replication_slots_positions(conn):
+    """
+    Return the WAL positions of the pglogical replication slots of the Source cluster.
+
+    A single query returns, for each slot, its database, the current WAL position of the cluster and the position
+    confirmed by the subscriber (in bytes), along with the lag between the two.
+    """
+    current_lsn, lsn_diff = get_wal_functions(conn)
+    # confirmed_flush_lsn is available since 9.6
+    confirmed_lsn = 'confirmed_flush_lsn' if int(get_setting_value(conn, 'server_version_num')) >= 90600 \
+        else 'restart_lsn'
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT database, slot_name, %(diff)s(%(current)s(), '0/0'), %(diff)s(%(confirmed)s, '0/0')
+        FROM pg_replication_slots
+        WHERE plugin = 'pglogical_output'
+        ORDER BY database, slot_name
+    """ % {'diff': lsn_diff, 'current': current_lsn, 'confirmed': confirmed_lsn})
+    result = []
+    for r in cur.fetchall():
+        result.append({
+            'database': r[0],
+            'slot': r[1],
+            'current_lsn': int(r[2]),
+            'confirmed_lsn': int(r[3]) if r[3] is not None else None,
+            'lag': int(r[2] - r[3]) if r[3] is not None else None,
+        })
+    return result
@@ -0,0 +1,175 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+from collections import deque
+from time import sleep, time
+from .replication import *
+from .state import get_step, is_step_done, record_step
+
+# Seconds the copy of a single table may take before it's reported as failed by run_table_sync()
+TABLE_SYNC_TIMEOUT = 24 * 3600
+# Step of the start operation recording whether all the data of a database subscribed without it has been copied
+TABLE_SYNC_STEP = 'table_sync'
+
+
+def get_tables_to_sync(db):
+    """
+    Return the tables of the replication sets of the Source database still to synchronize, along with their size.
+
+    Tables outside the replication sets (pgl_ddl_deploy bookkeeping, unlogged tables) can't be synchronized by the
+    subscription and are left out; the size is used only to order the tables. Tables synchronized by a previous,
+    interrupted start are skipped. Return None if the replication sets can't be read.
+    """
+    replicated = get_replicated_tables(db)
+    if replicated is None:
+        return None
+
+    sizes = get_tables_size(connect('Source', db_name=db))
+    synchronized = set((s['schema'], s['table']) for s in get_tables_sync_status(db) if is_table_synchronized(s))
+    tables = []
+    for t in replicated:
+        if (t['schema'], t['table']) in synchronized:
+            continue
+        if is_step_done('start', get_table_sync_step(t), 'Destination', db):
+            continue
+        size = sizes.get("%s.%s" % (t['schema'], t['table']), 0)
+        tables.append({'database': db, 'schema': t['schema'], 'table': t['table'], 'size': size})
+    return tables
+
+
+def get_table_sync_step(table):
+    """Return the step of the start operation recording the synchronization of a table"""
+    return "sync %s.%s" % (table['schema'], table['table'])
+
+
+def is_table_sync_pending(db):
+    """Return True if the subscription of the database was created without data and the copy isn't complete"""
+    step = get_step('start', TABLE_SYNC_STEP, 'Destination', db)
+    return step is not None and not step['result']
+
+
+def record_table_sync(table, result):
+    """Record the outcome of the synchronization of a table returned by get_tables_to_sync()"""
+    now = time()
+    record_step('start', get_table_sync_step(table), result, now, now, 'Destination', table['database'])
+
+
+def get_sync_workers_limit(requested):
+    """
+    Return the number of table synchronizations that can run concurrently.
+
+    pglogical runs a supervisor, plus a manager and an apply worker for each database, so only the remaining
+    max_worker_processes of the Destination cluster can be used for table synchronization.
+    """
+    conn = connect('Destination')
+    available = int(get_setting_value(conn, 'max_worker_processes')) - 2 * get_database_count(conn) - 1
+    return max(1, min(requested, available))
+
+
+def plan_table_sync(tables, workers):
+    """
+    Distribute the tables across a queue per worker.
+
+    Tables are assigned largest first to the least loaded queue (longest processing time first), so that the
+    queues end at about the same time and the largest tables don't delay the end of the synchronization.
+    """
+    queues = [{'size': 0, 'tables': deque()} for i in range(workers)]
+    for t in sorted(tables, key=lambda x: x['size'], reverse=True):
+        q = min(queues, key=lambda x: x['size'])
+        q['size'] += t['size']
+        q['tables'].append(t)
+    return [q['tables'] for q in queues if q['tables']]
+
+
+def run_table_sync(queues, on_done, interval=1, max_databases=None, throttle=None, on_pause=None,
+                   timeout=TABLE_SYNC_TIMEOUT):
+    """
+    Synchronize the tables of the queues, running one table of each queue at a time.
+
+    on_done(table, result) is called when the synchronization of a table ends or can't be started.
+    At most max_databases databases are in copy phase at the same time. If throttle() returns a reason, no new table
+    synchronization is started until it returns None again; on_pause(reason) is called on each change.
+    A table is reported as failed if it disappears from the subscription or if it isn't synchronized within timeout
+    seconds; its queue then moves on to the next table.
+    """
+    running = [None] * len(queues)
+    started = [None] * len(queues)
+    paused = None
+    while any(running) or any(queues):
+        reason = throttle() if throttle else None
+        if reason != paused and on_pause:
+            on_pause(reason)
+        paused = reason
+
+        for i, q in enumerate(queues):
+            while not paused and running[i] is None and q:
+                copying = set(t['database'] for t in running if t)
+                if max_databases and q[0]['database'] not in copying and len(copying) >= max_databases:
+                    break
+                t = q.popleft()
+                if resynchronize_table(t['database'], t['schema'], t['table']):
+                    running[i] = t
+                    started[i] = time()
+                else:
+                    on_done(t, False)
+
+        statuses = {}
+        for db in set(t['database'] for t in running if t):
+            # An empty list means the status couldn't be read: the tables are checked again at the next round
+            statuses[db] = dict(
+                ((s['schema'], s['table']), s) for s in get_tables_sync_status(db)
+            ) or None
+        for i, t in enumerate(running):
+            if t is None or statuses[t['database']] is None:
+                continue
+            status = statuses[t['database']].get((t['schema'], t['table']))
+            if status and is_table_synchronized(status):
+                on_done(t, True)
+                running[i] = None
+            elif status is None or time() - started[i] >= timeout:
+                on_done(t, False)
+                running[i] = None
+
+        if any(running) or any(queues):
+            sleep(interval)
+
+
+def get_source_load_throttle(max_active_sessions=None, max_lag=None):
+    """
+    Return a throttle function for run_table_sync based on the load of the Source cluster.
+
+    Synchronizations are paused while the active sessions on Source exceed max_active_sessions or while the
+    replication lag of a pglogical slot exceeds max_lag bytes. A probe failing with a database error doesn't pause.
+    """
+    def throttle():
+        conn = connect('Source')
+        if not conn:
+            return "Source cluster unreachable"
+        conn.autocommit = True
+        try:
+            if max_active_sessions is not None:
+                active = get_active_sessions_count(conn)
+                if active is not None and active > max_active_sessions:
+                    return "%d active sessions on Source" % active
+            if max_lag is not None:
+                lag = max([s['lag'] or 0 for s in get_replication_slots_positions(conn)] or [0])
+                if lag > max_lag:
+                    return "replication lag of %d bytes" % lag
+        except Error as e:
+            # A failed probe must not stop the synchronization: the load is checked again at the next round
+            print("Unable to check the load of Source, synchronization not paused: %s" % e)
+        return None
+    return throttle
@@ -0,0 +1,136 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import os
+import subprocess
+import uuid
+from ..config import get_tmp_folder
+from .database import get_connection_params
+
+# Databases that always exist in a cluster: their schema is restored in place instead of recreating them
+SYSTEM_DATABASES = ['postgres', 'template1']
+
+
+def _run(args, pg_pass):
+    env = os.environ.copy()
+    env['PGPASSFILE'] = pg_pass
+    devnull = open(os.devnull, 'w')
+    try:
+        return subprocess.call(args, env=env, stdout=devnull, stderr=devnull) == 0
+    except OSError:
+        return False
+    finally:
+        devnull.close()
+
+
+def _pipe(dump_args, restore_args, pg_pass):
+    """Run dump_args piping its output into restore_args, return True if both succeeded"""
+    env = os.environ.copy()
+    env['PGPASSFILE'] = pg_pass
+    devnull = open(os.devnull, 'w')
+    try:
+        dump = subprocess.Popen(dump_args, env=env, stdout=subprocess.PIPE, stderr=devnull)
+        try:
+            restore = subprocess.Popen(restore_args, env=env, stdin=dump.stdout, stdout=devnull, stderr=devnull)
+        except OSError:
+            dump.kill()
+            dump.wait()
+            return False
+        # Let the dump receive a SIGPIPE if the restore exits early
+        dump.stdout.close()
+        restore_result = restore.wait()
+        return dump.wait() == 0 and restore_result == 0
+    except OSError:
+        return False
+    finally:
+        devnull.close()
+
+
+def _connection_args(target):
+    params = get_connection_params(target)
+    return ['-U', params['user'], '-h', params['host'], '-p', params['port']]
+
+
+def get_dump_filename(kind, extension):
+    return "%s/%s_%s.%s" % (get_tmp_folder(), kind, uuid.uuid4().hex, extension)
+
+
+def dump_cluster_schema(pg_pass, fname):
+    """Dump globals and schema of all the Source databases in a single SQL file"""
+    return _run(['pg_dumpall'] + _connection_args('Source') + ['-s', '-f', fname, '--if-exists', '-c'], pg_pass)
+
+
+def restore_cluster_schema(pg_pass, fname):
+    """Restore into Destination a dump created by dump_cluster_schema"""
+    return _run(['psql'] + _connection_args('Destination') + ['-f', fname, '-d', 'postgres'], pg_pass)
+
+
+def dump_globals(pg_pass, fname):
+    """Dump roles and tablespaces of the Source cluster"""
+    return _run(['pg_dumpall'] + _connection_args('Source') + ['-g', '-f', fname], pg_pass)
+
+
+def restore_globals(pg_pass, fname):
+    """Restore into Destination a dump created by dump_globals"""
+    return _run(['psql'] + _connection_args('Destination') + ['-f', fname, '-d', 'postgres'], pg_pass)
+
+
+def dump_database_schema(pg_pass, db, fname):
+    """Dump the schema of a Source database using pg_dump custom format"""
+    return _run(['pg_dump'] + _connection_args('Source') + ['-s', '-Fc', '-f', fname, db], pg_pass)
+
+
+def restore_database_schema(pg_pass, db, fname, jobs=1):
+    """
+    Restore into Destination a dump created by dump_database_schema using pg_restore.
+
+    The database is dropped and recreated, except for SYSTEM_DATABASES whose objects are recreated in place.
+    """
+    return _run(_restore_database_args(db) + ['-j', str(jobs), fname], pg_pass)
+
+
+def _restore_database_args(db):
+    args = ['pg_restore'] + _connection_args('Destination') + ['-c', '--if-exists']
+    if db in SYSTEM_DATABASES:
+        return args + ['-d', db]
+    return args + ['-C', '-d', 'postgres']
+
+
+def stream_cluster_schema(pg_pass):
+    """Transfer globals and schema of all the databases piping pg_dumpall into psql"""
+    return _pipe(
+        ['pg_dumpall'] + _connection_args('Source') + ['-s', '--if-exists', '-c'],
+        ['psql'] + _connection_args('Destination') + ['-d', 'postgres'],
+        pg_pass
+    )
+
+
+def stream_globals(pg_pass):
+    """Transfer roles and tablespaces piping pg_dumpall -g into psql"""
+    return _pipe(
+        ['pg_dumpall'] + _connection_args('Source') + ['-g'],
+        ['psql'] + _connection_args('Destination') + ['-d', 'postgres'],
+        pg_pass
+    )
+
+
+def stream_database_schema(pg_pass, db):
+    """
+    Transfer the schema of a database piping pg_dump into pg_restore.
+
+    As in restore_database_schema the database is recreated, except for SYSTEM_DATABASES.
+    """
+    return _pipe(['pg_dump'] + _connection_args('Source') + ['-s', '-Fc', db], _restore_database_args(db), pg_pass)
@@ -0,0 +1,167 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from ..config import config
+from ..config import get_tmp_folder
+
+this = sys.modules[__name__]
+# Connection to the state file, shared by all the threads
+this.connection = None
+this.lock = threading.RLock()
+# Ordered (target, step) list of each operation, see begin_operation()
+this.operations = {}
+
+# Step recorded by end_operation() when all the steps of an operation succeeded
+COMPLETED_STEP = 'completed'
+
+
+def get_state_filename():
+    """
+    Return the path of the state file of the configured Source and Destination clusters.
+
+    The file name depends on the host and port of both clusters, so that configurations sharing the tmp folder don't
+    resume or report the steps run on other clusters.
+    """
+    clusters = "%s:%s/%s:%s" % (
+        config().get('Source', 'host'), config().get('Source', 'port'),
+        config().get('Destination', 'host'), config().get('Destination', 'port'),
+    )
+    return os.path.join(
+        get_tmp_folder(), 'pgrepup_state_%s.sqlite' % hashlib.sha1(clusters.encode('utf-8')).hexdigest()[:16]
+    )
+
+
+def _execute(query, params=()):
+    """Run a query on the state file and return the fetched rows. The state is best effort: errors are ignored"""
+    with this.lock:
+        try:
+            if this.connection is None:
+                this.connection = sqlite3.connect(get_state_filename(), check_same_thread=False)
+                this.connection.execute("""
+                    CREATE TABLE IF NOT EXISTS steps(
+                        operation TEXT NOT NULL, target TEXT NOT NULL, db TEXT NOT NULL, step TEXT NOT NULL,
+                        result INTEGER NOT NULL, started REAL NOT NULL, ended REAL NOT NULL,
+                        PRIMARY KEY (operation, target, db, step)
+                    )
+                """)
+            rows = this.connection.execute(query, params).fetchall()
+            this.connection.commit()
+            return rows
+        except sqlite3.Error:
+            return []
+
+
+def close_state():
+    with this.lock:
+        if this.connection is not None:
+            this.connection.close()
+            this.connection = None
+
+
+def begin_operation(operation, steps):
+    """
+    Start an operation made of the given ordered list of (target, step).
+
+    If the previous run of the operation was interrupted or had failures, it's resumed: steps already succeeded are
+    skipped by run_step. Return True if resuming.
+    """
+    this.operations[operation] = steps
+    if get_step(operation, COMPLETED_STEP):
+        clear_operation(operation)
+        return False
+    return bool(_execute("SELECT 1 FROM steps WHERE operation = ? LIMIT 1", (operation,)))
+
+
+def end_operation(operation):
+    """Mark the operation as completed if all its steps succeeded, so that the next run starts from scratch"""
+    if not _execute("SELECT 1 FROM steps WHERE operation = ? AND result = 0 LIMIT 1", (operation,)):
+        now = time.time()
+        record_step(operation, COMPLETED_STEP, True, now, now)
+
+
+def clear_operation(operation):
+    _execute("DELETE FROM steps WHERE operation = ?", (operation,))
+
+
+def clear_databases(operation, databases):
+    """Forget the steps of the operation run on the given databases, so that they are run again"""
+    for db in databases:
+        _execute("DELETE FROM steps WHERE operation = ? AND db = ?", (operation, db))
+
+
+def record_step(operation, step, result, started, ended, target='', db=''):
+    _execute(
+        "INSERT OR REPLACE INTO steps(operation, target, db, step, result, started, ended) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (operation, target, db, step, 1 if result else 0, started, ended)
+    )
+
+
+def get_step(operation, step, target='', db=''):
+    """Return the result, start and end time of a step, None if it was never run"""
+    rows = _execute(
+        "SELECT result, started, ended FROM steps WHERE operation = ? AND target = ? AND db = ? AND step = ?",
+        (operation, target, db, step)
+    )
+    if not rows:
+        return None
+    return {'result': bool(rows[0][0]), 'started': rows[0][1], 'ended': rows[0][2]}
+
+
+def get_steps_results(operation, step, target):
+    """Return the results of a step for each database as a dict"""
+    rows = _execute(
+        "SELECT db, result FROM steps WHERE operation = ? AND target = ? AND step = ?", (operation, target, step)
+    )
+    return dict((r[0], bool(r[1])) for r in rows)
+
+
+def is_step_done(operation, step, target='', db=''):
+    s = get_step(operation, step, target, db)
+    return bool(s and s['result'])
+
+
+def run_step(operation, step, function, target='', db=''):
+    """
+    Run function() as a step of the operation, unless it already succeeded in a previous run.
+
+    Running a step invalidates the following steps of the same database (of all databases for steps not bound to a
+    database), as they have to be run again. Return the result of function() and the elapsed seconds, None if the
+    step was skipped.
+    """
+    if is_step_done(operation, step, target, db):
+        return True, None
+
+    steps = this.operations.get(operation, [])
+    if (target, step) in steps:
+        for t, s in steps[steps.index((target, step)) + 1:]:
+            if db:
+                _execute("DELETE FROM steps WHERE operation = ? AND target = ? AND step = ? AND db = ?",
+                         (operation, t, s, db))
+            else:
+                _execute("DELETE FROM steps WHERE operation = ? AND target = ? AND step = ?", (operation, t, s))
+
+    started = time.time()
+    result = function()
+    ended = time.time()
+    record_step(operation, step, result, started, ended, target, db)
+    return result, ended - started
@@ -43,3 +43,27 @@ def output_cli_result(result, compensation=0):
 
 def output_hint(hint):
     print("    " + colored.yellow("Hint: " + hint))
+
+
+def format_size(size):
+    """Return a human readable representation of a size in bytes"""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return "%.1f %s" % (size, unit) if unit != 'B' else "%d %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+def format_duration(seconds):
+    """Return seconds in the hh:mm:ss format"""
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def format_timed_result(result, elapsed):
+    """Return OK/KO followed by the elapsed seconds, for output_cli_result. elapsed is None for resumed steps"""
+    if elapsed is None:
+        return colored.green("Already done")
+    if result:
+        return colored.green("OK %.2fs" % elapsed)
+    return colored.red("KO %.2fs" % elapsed)
@@ -14,6 +14,10 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from clint.textui import puts, colored
 
 
 def merge_two_dicts(x, y):
@@ -21,3 +25,66 @@ def merge_two_dicts(x, y):
     z = x.copy()
     z.update(y)
     return z
+
+
+def get_jobs(arguments):
+    """Return the number of concurrent jobs requested with the --jobs option"""
+    try:
+        jobs = int(arguments.get('jobs') or 1)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        puts(colored.red("Invalid number of jobs %s" % arguments.get('jobs')))
+        sys.exit(1)
+    return jobs
+
+
+def parallel_map(function, items, jobs=1):
+    """
+    Apply function to each item using up to jobs threads.
+
+    Yield (item, result) tuples in the same order of items, so that the caller can print the output of each item
+    without interleaving it with the others.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        results = pool.imap(function, items)
+        for item in items:
+            yield item, next(results)
+    finally:
+        pool.terminate()
+
+
+def timed(function):
+    """Wrap function so that it returns a (result, elapsed seconds) tuple"""
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = function(*args, **kwargs)
+        return result, time.time() - start
+    return wrapper
+
+
+def wait_until(predicate, timeout=None, initial_interval=0.01, max_interval=1.0):
+    """
+    Call predicate until it returns True, waiting with an exponential backoff between calls.
+
+    The first retry happens after initial_interval seconds, then the interval doubles up to max_interval.
+    Return False if predicate didn't return True within timeout seconds.
+    """
+    deadline = time.time() + timeout if timeout is not None else None
+    interval = initial_interval
+    while not predicate():
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            interval = min(interval, remaining)
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return True
@@ -0,0 +1,343 @@
+# Copyright (C) 2016-2018 Denis Gasparin <denis@gasparin.net>
+#
+# This file is part of Pgrepup.
+#
+# Pgrepup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pgrepup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pgrepup. If not, see <http://www.gnu.org/licenses/>.
+import sys
+import threading
+from .database import *
+
+# Primary key values (or rows) covered by each chunk checksum
+CHUNK_ROWS = 100000
+# Types of primary keys split in ranges of values
+INTEGER_TYPES = ['smallint', 'integer', 'bigint']
+# Rows of each table compared by the sampled verification
+SAMPLE_ROWS = 3000
+# Confidence level of the bound on the differing rows given by the sampled verification
+SAMPLE_CONFIDENCE = 0.95
+# Average row size assumed to estimate the rows of a table never analyzed
+ESTIMATED_ROW_BYTES = 100
+# Binary output function of the floating point types, whose text depends on the server version
+FLOAT_SEND = {
+    'real': 'float4send',
+    'double precision': 'float8send',
+    'real[]': 'array_send',
+    'double precision[]': 'array_send',
+}
+
+this = sys.modules[__name__]
+# Idle connections of the verification keyed by (target, dbname), reused across the tables
+this.idle = {}
+this.idle_lock = threading.Lock()
+
+
+def quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _escape(sql):
+    """Escape the % of a query built from identifiers before adding parameters placeholders"""
+    return sql.replace('%', '%%')
+
+
+def get_chunk_expression(table, chunk_rows):
+    """
+    Return the SQL expression assigning each row of a table returned by get_tables_primary_key to a chunk.
+
+    Tables with an integer primary key are split in ranges of chunk_rows values, other primary keys are hashed into
+    buckets of about chunk_rows rows each. Tables without a primary key are a single chunk.
+    """
+    pk = table['primary_key']
+    if not pk:
+        return "0"
+    if len(pk) == 1 and pk[0][1] in INTEGER_TYPES:
+        return "(t.%s / %d)" % (quote_ident(pk[0][0]), chunk_rows)
+    # The buckets must be the same on both clusters: they are computed from the Source estimate
+    buckets = table['rows'] // chunk_rows + 1
+    return "mod(abs(hashtext(%s)::bigint), %d)" % (_primary_key_text(table), buckets)
+
+
+def _primary_key_text(table):
+    columns = ["t.%s" % quote_ident(c) for c, t in table['primary_key']]
+    if len(columns) == 1:
+        return "%s::text" % columns[0]
+    return "ROW(%s)::text" % ", ".join(columns)
+
+
+def _chunk_range(chunk, chunk_rows):
+    """Return the lowest and highest integer primary key values of a chunk (division truncates toward zero)"""
+    if chunk > 0:
+        return chunk * chunk_rows, (chunk + 1) * chunk_rows - 1
+    if chunk < 0:
+        return (chunk - 1) * chunk_rows + 1, chunk * chunk_rows
+    return -(chunk_rows - 1), chunk_rows - 1
+
+
+def _open_cursor(target, db):
+    """
+    Return a cursor on an idle verify connection to the database, opening one if needed.
+
+    The output of the types depending on the session settings is pinned, so that the text of a row is the same on
+    both clusters. Release the cursor with _release_cursors().
+    """
+    with this.idle_lock:
+        idle = this.idle.get((target, db))
+        conn = idle.pop() if idle else None
+    if conn is not None and not conn.closed:
+        return conn.cursor()
+
+    conn = open_connection(target, db)
+    if conn is None:
+        raise psycopg2.OperationalError("Unable to connect to %s database %s" % (target, db))
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SET TimeZone = 'UTC';
+            SET DateStyle = 'ISO, YMD';
+            SET IntervalStyle = 'postgres';
+            SET bytea_output = 'hex';
+            SET extra_float_digits = 3
+        """)
+    except psycopg2.Error:
+        conn.close()
+        raise
+    return cur
+
+
+def _release_cursors(db, cursors, reuse=True):
+    """Give back the connections of the Source and Destination cursors to the idle ones, close them if not reuse"""
+    for target, cur in zip(['Source', 'Destination'], cursors):
+        if reuse and not cur.connection.closed:
+            with this.idle_lock:
+                this.idle.setdefault((target, db), []).append(cur.connection)
+        else:
+            cur.connection.close()
+
+
+def close_verify_connections():
+    """Close the idle connections opened by verify_table() and sample_table()"""
+    with this.idle_lock:
+        for connections in this.idle.values():
+            for conn in connections:
+                conn.close()
+        this.idle = {}
+
+
+def get_row_expression(cur, table):
+    """
+    Return the SQL expression of the text of a row of the table compared between the clusters.
+
+    Floating point columns are rendered by their binary representation, since their text changes with the version
+    (shortest exact output since PostgreSQL 12).
+    """
+    cur.execute("""
+        SELECT attname, atttypid::regtype::text FROM pg_attribute
+        WHERE attrelid = format('%%I.%%I', %s, %s)::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """, [table['schema'], table['table']])
+    columns = []
+    for name, column_type in cur.fetchall():
+        column = "t.%s" % quote_ident(name)
+        if column_type in FLOAT_SEND:
+            column = "encode(%s(%s), 'hex')" % (FLOAT_SEND[column_type], column)
+        columns.append(column)
+    return "ROW(%s)::text" % ", ".join(columns)
+
+
+def get_chunks_checksums(cur, table, chunk_rows, row):
+    """
+    Return the number of rows and the checksum of each chunk of the table, computed in a single scan.
+
+    row is the expression returned by get_row_expression().
+    """
+    cur.execute("""
+        SELECT %s AS chunk, COUNT(*), SUM(('x' || substr(md5(%s), 1, 16))::bit(64)::bigint)
+        FROM %s.%s t GROUP BY 1
+    """ % (get_chunk_expression(table, chunk_rows), row, quote_ident(table['schema']), quote_ident(table['table'])))
+    return dict((r[0], (r[1], r[2])) for r in cur.fetchall())
+
+
+def get_rows_hashes(cur, table, chunks, chunk_rows, row):
+    """Return the md5 of each row of the given chunks, keyed by the text representation of the primary key"""
+    expression = get_chunk_expression(table, chunk_rows)
+    query = _escape("SELECT %s, md5(%s) FROM %s.%s t WHERE %s" % (
+        _primary_key_text(table), row, quote_ident(table['schema']), quote_ident(table['table']), expression
+    )) + " = ANY(%s)"
+    pk = table['primary_key']
+    result = {}
+    if len(pk) == 1 and pk[0][1] in INTEGER_TYPES:
+        # Let the primary key index restrict the scan to the range of each chunk
+        for chunk in chunks:
+            cur.execute(query + " AND t.%s BETWEEN %%s AND %%s" % _escape(quote_ident(pk[0][0])),
+                        [[chunk]] + list(_chunk_range(chunk, chunk_rows)))
+            result.update(cur.fetchall())
+    else:
+        cur.execute(query, [list(chunks)])
+        result.update(cur.fetchall())
+    return result
+
+
+def verify_table(db, table, chunk_rows=CHUNK_ROWS):
+    """
+    Compare a table of a database between Source and Destination.
+
+    Row counts and checksums of the chunks are compared first; only the chunks whose checksum differs are compared
+    row by row. Return a dict with the row counts, the number of chunks, the primary keys missing, extra or different
+    on Destination and the error, if any.
+    """
+    result = {
+        'source_rows': None, 'destination_rows': None, 'chunks': 0, 'mismatching_chunks': [],
+        'missing': [], 'extra': [], 'different': [], 'error': None,
+    }
+    cursors = []
+    reuse = True
+    try:
+        for target in ['Source', 'Destination']:
+            cursors.append(_open_cursor(target, db))
+        row = get_row_expression(cursors[0], table)
+        src, dest = [get_chunks_checksums(c, table, chunk_rows, row) for c in cursors]
+        chunks = set(src.keys()) | set(dest.keys())
+        result['source_rows'] = sum(v[0] for v in src.values())
+        result['destination_rows'] = sum(v[0] for v in dest.values())
+        result['chunks'] = len(chunks)
+        result['mismatching_chunks'] = sorted(c for c in chunks if src.get(c) != dest.get(c))
+
+        if result['mismatching_chunks'] and table['primary_key']:
+            src_rows, dest_rows = [
+                get_rows_hashes(c, table, result['mismatching_chunks'], chunk_rows, row) for c in cursors
+            ]
+            result['missing'] = sorted(k for k in src_rows if k not in dest_rows)
+            result['extra'] = sorted(k for k in dest_rows if k not in src_rows)
+            result['different'] = sorted(k for k in src_rows if k in dest_rows and src_rows[k] != dest_rows[k])
+    except psycopg2.Error as e:
+        result['error'] = str(e).strip()
+        # Don't hand out a connection in an unknown state
+        reuse = False
+    finally:
+        _release_cursors(db, cursors, reuse)
+    return result
+
+
+def is_table_verified(table, result):
+    """Return True if the result of verify_table shows no difference"""
+    if result['error'] or result['source_rows'] != result['destination_rows']:
+        return False
+    if not table['primary_key']:
+        return not result['mismatching_chunks']
+    # Chunks may differ because of rows changed between the checksums and the drill down
+    return not (result['missing'] or result['extra'] or result['different'])
+
+
+def get_sample_percent(rows, sample_rows):
+    """Return the TABLESAMPLE percentage needed to read about sample_rows rows of a table of rows rows"""
+    if rows <= sample_rows:
+        return 100.0
+    return 100.0 * sample_rows / rows
+
+
+def _estimate_rows(cur, table):
+    """Return the rows of the table estimated by the planner statistics, or by its size if it was never analyzed"""
+    if table['rows'] > 0:
+        return table['rows']
+    cur.execute("SELECT pg_relation_size(format('%%I.%%I', %s, %s)::regclass)", [table['schema'], table['table']])
+    return cur.fetchone()[0] // ESTIMATED_ROW_BYTES
+
+
+def sample_table(db, table, sample_rows=SAMPLE_ROWS):
+    """
+    Compare a random sample of the rows of a table between Source and Destination.
+
+    Blocks of the Source table are sampled with TABLESAMPLE SYSTEM (a full scan filtered by random() before
+    PostgreSQL 9.5), then the same primary keys are looked up on Destination. Rows existing only on Destination can't
+    be detected. Return a dict with the number of sampled rows, the number of independently sampled units (blocks, or
+    rows before 9.5) for get_differences_bound(), the primary keys missing or different on Destination and the error,
+    if any.
+    """
+    result = {'sampled': 0, 'units': 0, 'missing': [], 'different': [], 'error': None}
+    pk = table['primary_key']
+    if not pk:
+        result['error'] = "the table has no primary key"
+        return result
+
+    name = _escape("%s.%s" % (quote_ident(table['schema']), quote_ident(table['table'])))
+    columns = _escape(", ".join("t.%s::text" % quote_ident(c) for c, t in pk))
+    cursors = []
+    reuse = True
+    try:
+        for target in ['Source', 'Destination']:
+            cursors.append(_open_cursor(target, db))
+        src, dest = cursors
+        row = _escape(get_row_expression(src, table))
+
+        percent = get_sample_percent(_estimate_rows(src, table), sample_rows)
+
+        # The block of each row is returned along with it
+        src.execute("SHOW server_version_num")
+        blocks = int(src.fetchone()[0]) >= 90500
+        if blocks:
+            src.execute("SELECT %s, (t.ctid::text::point)[0], md5(%s) FROM %s t TABLESAMPLE SYSTEM (%%s)" % (
+                columns, row, name
+            ), [percent])
+        else:
+            src.execute("SELECT %s, (t.ctid::text::point)[0], md5(%s) FROM %s t WHERE random() * 100 < %%s" % (
+                columns, row, name
+            ), [percent])
+        sampled = src.fetchall()
+        src_rows = dict((tuple(r[:-2]), r[-1]) for r in sampled)
+
+        # Primary keys are passed as an array of text for each column and cast back to the column type
+        dest.execute("""
+            SELECT %s, md5(%s) FROM %s t
+            WHERE (%s) IN (SELECT %s FROM unnest(%s) u(%s))
+        """ % (
+            columns, row, name,
+            _escape(", ".join("t.%s" % quote_ident(c) for c, t in pk)),
+            ", ".join("u.c%d::%s" % (i, t) for i, (c, t) in enumerate(pk)),
+            ", ".join(["%s::text[]"] * len(pk)),
+            ", ".join("c%d" % i for i in range(len(pk))),
+        ), [[k[i] for k in src_rows] for i in range(len(pk))])
+        dest_rows = dict((tuple(r[:-1]), r[-1]) for r in dest.fetchall())
+
+        result['sampled'] = len(src_rows)
+        # Rows of the same block are sampled together: only the blocks are independent
+        result['units'] = len(set(r[-2] for r in sampled)) if blocks else len(src_rows)
+        result['missing'] = sorted(_format_key(k) for k in src_rows if k not in dest_rows)
+        result['different'] = sorted(
+            _format_key(k) for k in src_rows if k in dest_rows and src_rows[k] != dest_rows[k]
+        )
+    except psycopg2.Error as e:
+        result['error'] = str(e).strip()
+        # Don't hand out a connection in an unknown state
+        reuse = False
+    finally:
+        _release_cursors(db, cursors, reuse)
+    return result
+
+
+def _format_key(key):
+    return key[0] if len(key) == 1 else "(%s)" % ", ".join(key)
+
+
+def get_differences_bound(units, confidence=SAMPLE_CONFIDENCE):
+    """
+    Return the highest fraction of differing rows compatible, at the given confidence level, with a sample of units
+    independently sampled rows or blocks without differences.
+
+    With blocks the bound is on the fraction of blocks holding differing rows, which is not lower than the fraction
+    of differing rows.
+    """
+    if not units:
+        return 1.0
+    return 1 - (1 - confidence) ** (1.0 / units)